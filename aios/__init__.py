@@ -1,6 +1,6 @@
-
 from aios.object import Object
 from aios.state import State
+from aios.propagation import CancelToken, FrozenError, PropagationError, TransitionCancelled, transaction
 
 
 
@@ -0,0 +1,332 @@
+import collections
+import heapq
+import logging
+import time
+from typing import List
+
+from aios.logic import ConditionalInputOutput
+from aios.object import Object
+from aios.propagation import FrozenError, PropagationError
+from aios.state import State, logger as state_logger
+
+logger = logging.getLogger('aios.frozen')
+
+
+class FrozenPlan(object):
+    """
+    The transitions planned by FrozenGraph.plan, in the order they are applied - the State
+    id, state index, source and priority of each. values() gives the same nodes as the
+    ordered dict returned by Propagation.plan.
+    """
+
+    __slots__ = ('graph', 'ids', 'indices', 'sources', 'priorities')
+
+    def __init__(self, graph: 'FrozenGraph', ids: List[int], indices: List[int], sources: List, priorities: List[int]):
+        self.graph = graph
+        self.ids = ids
+        self.indices = indices
+        self.sources = sources
+        self.priorities = priorities
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        states = self.graph.states
+        return (states[sid] for sid in self.ids)
+
+    def values(self):
+        states = self.graph.states
+        for sid, index, source, priority in zip(self.ids, self.indices, self.sources, self.priorities):
+            state = states[sid]
+            yield state, state._schema.states[index], source, None, priority
+
+
+class FrozenGraph(object):
+    """
+    FrozenGraph is a compiled copy of the set_input links between a set of States, for
+    graphs which don't change once they've been set up - see freeze()
+
+    Each State has an integer id, and each of its states a slot at base[id] + state
+    index. The links from each slot are kept in CSR form - the links from slot k are
+    dests[indptr[k]:indptr[k + 1]] (State ids), with the state index and priority of
+    each link in dest_states and priorities. Gates (ConditionalInputOutput) are
+    compiled into a table of (gate, input) per State, which is updated directly
+    rather than through the gate's outputs.
+    """
+
+    def __init__(self, states: List[State]):
+        self.states = states
+        self.ids = {state: sid for sid, state in enumerate(states)}
+
+        # plain lists of ints, as indexing them is quicker than indexing an array.array
+        self.base = [0]
+        for state in states:
+            self.base.append(self.base[-1] + len(state.schema))
+
+        self.indptr = [0]
+        self.dests = []
+        self.dest_states = []
+        self.priorities = []
+        for state in states:
+            for name in state.schema:
+                for dest, dest_state in state.downstream(name):
+                    self.dests.append(self.ids[dest])
+                    self.dest_states.append(dest.schema.index[dest_state])
+                    self.priorities.append(state.priority((name, dest, dest_state)))
+                self.indptr.append(len(self.dests))
+        self.prioritised = any(self.priorities)
+        # async_required can't change once frozen
+        self.asynchronous = any(_.async_required for _ in states)
+
+        # State id -> [(gate, input idx)], and its other outputs
+        self.gates = []
+        self.outputs = []
+        for state in states:
+            gates = []
+            outputs = []
+            for obj in state._outputs or ():
+                gate = getattr(obj, 'parent', None)
+                if isinstance(gate, ConditionalInputOutput) and not obj.require_async():
+                    gates.append((gate, obj.idx))
+                else:
+                    outputs.append(obj)
+            self.gates.append(gates)
+            self.outputs.append(outputs)
+
+    def freeze(self) -> 'FrozenGraph':
+        for state in self.states:
+            if state._frozen is not None and state._frozen is not self:
+                raise FrozenError('{} is already frozen'.format(state.__name__))
+        for state in self.states:
+            state._frozen = self
+        return self
+
+    def thaw(self):
+        """Unfreeze the States, so their links and outputs can be changed again"""
+        for state in self.states:
+            if state._frozen is self:
+                state._frozen = None
+
+    def plan(self, propagation, visited: set=None) -> FrozenPlan:
+        """Propagation.plan, from the compiled links"""
+        states = self.states
+        base = self.base
+        indptr = self.indptr
+        dests = self.dests
+        dest_states = self.dest_states
+        max_steps = propagation.max_steps
+
+        if len(propagation.pending) == 1:
+            # a single change to a State without links (eg the input or output of a gate)
+            # needs none of the queues below
+            state, new_state, source, _, priority = propagation.pending[0]
+            sid = self.ids[state]
+            index = state._schema.index[new_state]
+            slot = base[sid] + index
+            if indptr[slot] == indptr[slot + 1]:
+                propagation.pending = collections.deque()
+                if visited is not None:
+                    visited.add(state)
+                if index == state._index:
+                    return FrozenPlan(self, (), (), (), ())
+                propagation.steps += 1
+                if propagation.steps > max_steps:
+                    raise PropagationError('Propagation exceeded {} steps'.format(max_steps))
+                return FrozenPlan(self, (sid,), (index,), (source,), (priority,))
+
+        queue = collections.deque()
+        # without any priorities, every node goes on the queue
+        priorities = self.priorities if self.prioritised else None
+        for state, new_state, source, _, priority in propagation.pending:
+            queue.append((self.ids[state], state._schema.index[new_state], source, -1, priority))
+            if priority:
+                priorities = self.priorities
+        propagation.pending = collections.deque()
+        prioritised = []
+        seq = 0
+
+        # planned nodes, as (State id, state index, source, parent node, priority)
+        nodes = []
+        # State id -> its last node, in the order the States were first planned
+        planned = dict()
+
+        while queue or prioritised:
+            if prioritised and (prioritised[0][0] < 0 or not queue):
+                node = heapq.heappop(prioritised)[2]
+            else:
+                node = queue.popleft()
+            sid, index, source, parent, priority = node
+            state = states[sid]
+            if visited is not None:
+                visited.add(state)
+
+            last = planned.get(sid)
+            if last is not None:
+                if nodes[last][1] == index:
+                    continue
+                ancestor = parent
+                while ancestor >= 0:
+                    if nodes[ancestor][0] == sid:
+                        raise PropagationError('Cycle detected: {} -> {} (Source: {})'.format(
+                            state.__name__, state._schema.states[index], getattr(source, '__name__', source)))
+                    ancestor = nodes[ancestor][3]
+            elif index == state._index:
+                continue
+
+            propagation.steps += 1
+            if propagation.steps > max_steps:
+                raise PropagationError('Propagation exceeded {} steps'.format(max_steps))
+
+            planned[sid] = number = len(nodes)
+            nodes.append(node)
+            slot = base[sid] + index
+            if priorities is None:
+                for link in range(indptr[slot], indptr[slot + 1]):
+                    queue.append((dests[link], dest_states[link], state, number, 0))
+                continue
+            for link in range(indptr[slot], indptr[slot + 1]):
+                link_priority = priorities[link] or priority
+                if link_priority:
+                    heapq.heappush(prioritised, (-link_priority, seq, (dests[link], dest_states[link], state, number, link_priority)))
+                    seq += 1
+                else:
+                    queue.append((dests[link], dest_states[link], state, number, 0))
+
+        if len(planned) != len(nodes):
+            nodes = [nodes[_] for _ in planned.values()]
+        ids, indices, sources, _, priorities = zip(*nodes) if nodes else ((),) * 5
+        return FrozenPlan(self, ids, indices, sources, priorities)
+
+    def apply(self, planned: FrozenPlan, started: float):
+        """
+        Propagation._apply, for a plan from plan(). States without outputs (other than
+        gates) are committed directly, and their gates updated from the compiled tables.
+        """
+        if self.asynchronous:
+            for state in planned:
+                state.check_for_async()
+
+        # each run of nodes with the same priority is locked and applied in turn
+        priorities = planned.priorities
+        if len(priorities) < 2:
+            self._apply_band(planned, 0, len(priorities), started)
+            return
+        start = 0
+        for end in range(1, len(priorities) + 1):
+            if end == len(priorities) or priorities[end] != priorities[start]:
+                self._apply_band(planned, start, end, started)
+                start = end
+
+    def _apply_band(self, planned: FrozenPlan, start: int, end: int, started: float):
+        states = self.states
+        outputs = self.outputs
+        gates = self.gates
+        metrics = State.metrics
+        observers = State.observers
+        debug = state_logger.isEnabledFor(logging.DEBUG)
+        ids = planned.ids
+        indices = planned.indices
+        sources = planned.sources
+
+        # node -> locked outputs, for the States with outputs
+        acquired = dict()
+        try:
+            for node in range(start, end):
+                sid = ids[node]
+                if outputs[sid] or metrics is not None:
+                    state = states[sid]
+                    new_state = state._schema.states[indices[node]]
+                    if state.check_change_state(new_state, sources[node]):
+                        acquired[node] = state._acquire(new_state)
+
+            for node in range(start, end):
+                sid = ids[node]
+                index = indices[node]
+                state = states[sid]
+                if outputs[sid] or metrics is not None:
+                    locked = acquired.get(node)
+                    if locked is not None:
+                        state._enact(state._schema.states[index], locked)
+                        if metrics is not None:
+                            metrics.enacted(planned.priorities[node], time.perf_counter() - started)
+                    continue
+
+                old = state._index
+                if index == old:
+                    continue
+                if debug:
+                    state.check_change_state(state._schema.states[index], sources[node])
+                state._index = index
+                for observer in observers:
+                    observer(state, old, index)
+
+                for gate, idx in gates[sid]:
+                    gate.locks[idx] = state._schema.states[index]
+                    try:
+                        changed = gate.input_changed(idx)
+                    finally:
+                        gate.locks[idx] = None
+                    if changed:
+                        gate.notify()
+        finally:
+            for locked in acquired.values():
+                for obj in locked:
+                    obj.release_lock()
+
+
+def freeze(*roots) -> FrozenGraph:
+    """
+    Compile the set_input links between the States below each root (an Object or a State)
+    and every State linked to them into a FrozenGraph, which propagations then use.
+
+    Long chains and fan outs gain the most. Each change to a gate's input or output
+    is a propagation of a single State, so for gate-heavy graphs most of the cost is
+    still setting up each change_state, and the gain is smaller.
+
+    >>> from aios import State, FrozenError
+    >>> relays = [State(['on', 'off'], name='relay{}'.format(i), default='off') for i in range(100)]
+    >>> for prev, relay in zip(relays, relays[1:]):
+    ...     relay.on = prev.on
+    ...     relay.off = prev.off
+    >>> alarm = State(['ringing', 'silent'], name='alarm', default='silent')
+    >>> gate = ConditionalInputOutput(all, [relays[-1].on, relays[50].on], [alarm.ringing])
+    >>> graph = freeze(relays[0])
+    >>> len(graph.states), len(graph.dests)
+    (101, 198)
+    >>> relays[0].on = True
+    >>> print(relays[-1], alarm)
+    relay99=[ON, off] alarm=[RINGING, silent]
+
+    Links and outputs can't be changed once frozen, until the graph is thawed
+
+    >>> relays[0].on = alarm.ringing
+    Traceback (most recent call last):
+    ...
+    aios.propagation.FrozenError: Can't link relay0 to alarm - the graph is frozen
+    >>> graph.thaw()
+    >>> relays[0].on = alarm.ringing
+    """
+    pending = []
+    for root in roots:
+        if isinstance(root, Object):
+            pending.extend(obj for _, obj in root._aios_walk() if isinstance(obj, State))
+        else:
+            pending.append(root)
+
+    # every State linked to or from the roots, in the order they are found
+    found = dict()
+    while pending:
+        state = pending.pop()
+        if state in found:
+            continue
+        found[state] = None
+        for links in (state._callbacks or {}).values():
+            pending.extend(dest for dest, _ in links)
+        pending.extend(state._inputs or ())
+        for obj in state._outputs or ():
+            gate = getattr(obj, 'parent', None)
+            if isinstance(gate, ConditionalInputOutput):
+                pending.extend(dest for dest, _ in gate.inputs + gate.outputs)
+
+    return FrozenGraph(list(found)).freeze()
@@ -0,0 +1,333 @@
+"""
+An append-only journal of the transitions of the States below an Object, so the
+transitions since the last snapshot can be recovered after a crash.
+
+The journal is a directory of numbered segments (00000001.journal, ...) and
+snapshots (00000003.snapshot, which is followed by segment 3 onwards). Each
+transition is a line of utf-8 text - the path of the State below the Object, a
+space and the new state. A line without a trailing newline (a write interrupted
+by a crash) is ignored by replay.
+"""
+
+import asyncio
+import logging
+import os
+import re
+import threading
+
+from aios.object import Object, _path, _root
+from aios.propagation import Propagation
+from aios.snapshot import _sync_gates
+from aios.state import State
+
+logger = logging.getLogger('aios.journal')
+
+NONE = 'none'
+BATCH = 'batch'
+TRANSITION = 'transition'
+
+SEGMENT = '{:08d}.journal'
+SNAPSHOT = '{:08d}.snapshot'
+FILENAME = re.compile(r'^(\d{8})\.(journal|snapshot)$')
+
+
+def _files(directory: str, kind: str):
+    """Return the (number, filename) of each segment or snapshot in directory, in order"""
+    files = []
+    for _ in os.listdir(directory):
+        match = FILENAME.match(_)
+        if match and match.group(2) == kind:
+            files.append((int(match.group(1)), os.path.join(directory, _)))
+    return sorted(files)
+
+
+class Journal(object):
+    """
+    Journal records every transition of the States below root, once enabled.
+
+    >>> import asyncio, tempfile
+    >>> def build():
+    ...     return Object(name='site', children={
+    ...         'b{}'.format(b): Object(children={'door': State(['open', 'closed'], default='closed')})
+    ...         for b in range(3)})
+    >>> site = build()
+    >>> directory = tempfile.mkdtemp()
+    >>> journal = Journal(site, directory).enable()
+    >>> site.b0.door.open = True
+    >>> site.b2.door.open = True
+    >>> site.b0.door.closed = True
+    >>> journal.close()
+
+    replay() rebuilds the state from the latest snapshot (if any) and the journal,
+    without calling any outputs, returning the number of transitions read
+
+    >>> site = build()
+    >>> replay(site, directory)
+    3
+    >>> print(site)
+    <site <site.b0 door=[open, CLOSED]> <site.b1 door=[open, CLOSED]> <site.b2 door=[OPEN, closed]>>
+
+    Transitions are queued in memory and written by a background thread, which
+    writes everything queued since its last write at once (a group commit). The
+    durability sets how far a transition is guaranteed to be on disk :-
+
+    * 'none' - written to the operating system, but never fsynced
+    * 'batch' - each group commit is fsynced, but change_state doesn't wait for it
+    * 'transition' - change_state (and change_state_async, and transactions) return once
+      the transition has been fsynced. change_state blocks while it waits, change_state_async
+      awaits without blocking the event loop
+
+    >>> journal = Journal(site, directory, durability='transition').enable()
+    >>> loop = asyncio.get_event_loop()
+    >>> loop.run_until_complete(site.b1.door.change_state_async('open'))
+    >>> journal.durable == journal.recorded
+    True
+
+    Changes made in a transaction (see aios.transaction) are waited for once it ends
+
+    >>> from aios import transaction
+    >>> with transaction():
+    ...     site.b0.door.open = True
+    ...     site.b2.door.closed = True
+    >>> journal.durable == journal.recorded
+    True
+    >>> with transaction():
+    ...     site.b0.door.closed = True
+    ...     site.b2.door.open = True
+
+    Segments are rotated once they reach segment_bytes. checkpoint() saves a snapshot
+    and removes the segments and snapshots it replaces, so replay stays quick
+
+    >>> journal.checkpoint()
+    >>> site.b1.door.closed = True
+    >>> journal.close()
+    >>> sorted(os.listdir(directory))
+    ['00000003.journal', '00000003.snapshot']
+    >>> site = build()
+    >>> replay(site, directory)
+    1
+    >>> print(site)
+    <site <site.b0 door=[open, CLOSED]> <site.b1 door=[open, CLOSED]> <site.b2 door=[OPEN, closed]>>
+    """
+
+    def __init__(self, root: Object, directory: str, durability: str=BATCH, segment_bytes: int=64 * 1024 * 1024):
+        assert durability in (NONE, BATCH, TRANSITION)
+        self.root = root
+        self.directory = directory
+        self.durability = durability
+        self.segment_bytes = segment_bytes
+        os.makedirs(directory, exist_ok=True)
+
+        existing = _files(directory, 'journal') + _files(directory, 'snapshot')
+        self.segment = max((_[0] for _ in existing), default=0) + 1
+
+        self.condition = threading.Condition()
+        # encoded transitions, and (segment, snapshot) tuples to start a new segment
+        self.pending = []
+        self.recorded = 0
+        self.durable = 0
+        # (recorded, future) for change_state_async calls waiting for a transition to be fsynced
+        self.waiters = []
+        self.closing = False
+        self.thread = None
+
+    def enable(self) -> 'Journal':
+        self.thread = threading.Thread(target=self._write, args=(self.segment,),
+                                       name='aios-journal', daemon=True)
+        self.thread.start()
+        State.journal = self
+        Propagation.journal = self
+        State.observers.append(self.record)
+        return self
+
+    def close(self):
+        """Stop recording, and wait for the queued transitions to be written"""
+        if State.journal is self:
+            State.journal = None
+        if Propagation.journal is self:
+            Propagation.journal = None
+        if self.record in State.observers:
+            State.observers.remove(self.record)
+        with self.condition:
+            self.closing = True
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def record(self, state: State, old: int, new: int):
+        parent = getattr(state, '__parent__', None)
+        if parent is None or parent._aios_cached('_aios_root', _root) is not self.root:
+            return
+        prefix = parent._aios_cached('_aios_path', _path)
+        line = '{}.{} {}\n'.format(prefix, state.__name__, state._schema.states[new]) if prefix else \
+            '{} {}\n'.format(state.__name__, state._schema.states[new])
+
+        with self.condition:
+            self.pending.append(line.encode())
+            self.recorded += 1
+            self.condition.notify()
+
+    def commit(self):
+        """With 'transition' durability, wait until every recorded transition has been fsynced"""
+        if self.durability != TRANSITION:
+            return
+        with self.condition:
+            recorded = self.recorded
+            self.condition.wait_for(lambda: self.durable >= recorded or self.thread is None)
+
+    async def commit_async(self):
+        if self.durability != TRANSITION:
+            return
+        with self.condition:
+            if self.durable >= self.recorded:
+                return
+            future = asyncio.get_event_loop().create_future()
+            self.waiters.append((self.recorded, future))
+        await future
+
+    def checkpoint(self):
+        """Save a snapshot of root, after which the journal starts a new segment"""
+        with self.condition:
+            self.segment += 1
+            segment = self.segment
+            filename = os.path.join(self.directory, SNAPSHOT.format(segment))
+            self.root._aios_snapshot(filename)
+            self.pending.append((segment, filename))
+            self.condition.notify()
+
+    def _write(self, segment: int):
+        fh = open(os.path.join(self.directory, SEGMENT.format(segment)), 'ab')
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.pending or self.closing)
+                batch, self.pending = self.pending, []
+                recorded = self.recorded
+                closing = self.closing
+
+            chunk = []
+            for _ in batch:
+                if type(_) is bytes:
+                    chunk.append(_)
+                    continue
+                fh = self._rotate(fh, chunk, *_)
+                chunk = []
+
+            if chunk:
+                fh.write(b''.join(chunk))
+            fh.flush()
+            if self.durability != NONE:
+                os.fsync(fh.fileno())
+            self._durable(recorded)
+
+            if closing and not self.pending:
+                fh.close()
+                return
+
+            if fh.tell() >= self.segment_bytes:
+                with self.condition:
+                    self.segment += 1
+                    segment = self.segment
+                fh = self._rotate(fh, [], segment, None)
+
+    def _rotate(self, fh, chunk, segment: int, snapshot: str):
+        fh.write(b''.join(chunk))
+        fh.flush()
+        if self.durability != NONE:
+            os.fsync(fh.fileno())
+        fh.close()
+
+        if snapshot is not None:
+            for number, filename in _files(self.directory, 'journal') + _files(self.directory, 'snapshot'):
+                if number < segment:
+                    os.remove(filename)
+
+        return open(os.path.join(self.directory, SEGMENT.format(segment)), 'ab')
+
+    def _durable(self, recorded: int):
+        with self.condition:
+            self.durable = recorded
+            self.condition.notify_all()
+            waiters = [_ for _ in self.waiters if _[0] <= recorded]
+            self.waiters = [_ for _ in self.waiters if _[0] > recorded]
+        for _, future in waiters:
+            future.get_loop().call_soon_threadsafe(_resolve, future)
+
+
+def _resolve(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
+
+
+def replay(root: Object, directory: str) -> int:
+    """
+    Restore the States below root from the latest snapshot in directory and the
+    journal segments which follow it, without calling outputs (State.observers are
+    notified of each State which changes, and ConditionalInputOutput gates are
+    updated to match). Returns the number of transitions read.
+
+    >>> import tempfile
+    >>> from aios.logic import ConditionalInputOutput
+    >>> def build():
+    ...     site = Object(name='site', children={
+    ...         'a': State(['on', 'off'], default='off'), 'b': State(['on', 'off'], default='off'),
+    ...         'alarm': State(['ringing', 'silent'], default='silent')})
+    ...     gate = ConditionalInputOutput(all, [site.a.on, site.b.on], [site.alarm.ringing])
+    ...     return site, gate
+    >>> site, gate = build()
+    >>> directory = tempfile.mkdtemp()
+    >>> journal = Journal(site, directory).enable()
+    >>> site.a.on = True
+    >>> site.b.on = True
+    >>> site.alarm.silent = True
+    >>> journal.close()
+    >>> site, gate = build()
+    >>> replay(site, directory)
+    4
+    >>> gate.satisfied, gate.result
+    (2, True)
+    """
+    snapshots = _files(directory, 'snapshot')
+    start = 0
+    if snapshots:
+        start, filename = snapshots[-1]
+        root._aios_restore(filename)
+
+    # only the last transition of each State matters
+    latest = dict()
+    count = 0
+    for number, filename in _files(directory, 'journal'):
+        if number < start:
+            continue
+        with open(filename, 'rb') as fh:
+            lines = fh.read().decode().split('\n')
+        # the last line is empty, or was cut short by a crash
+        for line in lines[:-1]:
+            path, _, new_state = line.rpartition(' ')
+            latest[path] = new_state
+        count += len(lines) - 1
+
+    observers = State.observers
+    # (State, new_state) set directly, for _sync_gates
+    restored = []
+    for path, new_state in latest.items():
+        try:
+            state = root._aios_lookup(path)
+        except KeyError:
+            logger.warning('Skipped {} - no longer exists'.format(path))
+            continue
+        index = state._schema.index.get(new_state)
+        if index is None:
+            logger.warning('Skipped {} - state {} no longer exists'.format(path, new_state))
+            continue
+        old = state._index
+        if old == index:
+            continue
+        state._index = index
+        if state._outputs:
+            restored.append((state, new_state))
+        for observer in observers:
+            observer(state, old, index)
+
+    _sync_gates(restored)
+    return count
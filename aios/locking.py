@@ -0,0 +1,140 @@
+import asyncio
+import logging
+import threading
+from typing import Iterable
+
+from aios.propagation import Propagation, PropagationError
+from aios.state import State
+
+logger = logging.getLogger('aios.locking')
+
+
+class Locking(object):
+    """
+    Locking makes State transitions thread-safe, once enabled.
+
+    Each State has its own lock. Every round of a propagation locks all of the States
+    it visits (the States it changes, and the linked States it checks) before changing
+    any of them, so transitions on separate parts of the hierarchy run in parallel,
+    while transitions which touch the same States are serialised. Locks are always
+    taken in the same order (by id), so two propagations can't deadlock.
+
+    >>> import time
+    >>> from aios import Object
+    >>> class Relay(object):
+    ...     def acquire_lock(self, new_state): pass
+    ...     def change(self):
+    ...         time.sleep(0.1)
+    ...     def release_lock(self): pass
+    ...     def require_async(self): return False
+    >>> def device(name):
+    ...     device = Object(name=name, children={
+    ...         'power': State(['on', 'off'], default='off'), 'fan': State(['on', 'off'], default='off')})
+    ...     device.fan.on = device.power.on
+    ...     device.fan.set_output(Relay())
+    ...     return device
+    >>> devices = [device('device{}'.format(_)) for _ in range(4)]
+    >>> locking = Locking().enable()
+    >>> threads = [threading.Thread(target=setattr, args=(_.power, 'on', True)) for _ in devices]
+    >>> start = time.monotonic()
+    >>> for _ in threads:
+    ...     _.start()
+    >>> for _ in threads:
+    ...     _.join()
+    >>> time.monotonic() - start < 0.3
+    True
+    >>> [_.fan.current_state for _ in devices], locking.contention
+    (['on', 'on', 'on', 'on'], 0)
+
+    Transitions which wait for a lock held by another thread are counted in contention
+
+    >>> shared = device('shared')
+    >>> threads = [threading.Thread(target=setattr, args=(shared.power, _, True)) for _ in ('on', 'off')]
+    >>> for _ in threads:
+    ...     _.start()
+    ...     time.sleep(0.02)
+    >>> for _ in threads:
+    ...     _.join()
+    >>> shared.power.current_state, shared.fan.current_state, locking.contention
+    ('off', 'on', 1)
+    >>> locking.disable()
+
+    ConditionalInputOutput gates update their count of satisfied inputs under a lock of
+    their own. change_state_async polls for the locks rather than blocking the event loop.
+    Note State.observers are called on the thread making the change.
+    """
+
+    def __init__(self, poll: float=0.001):
+        self.poll = poll
+        # State or gate -> threading.Lock
+        self.locks = dict()
+        # State -> ident of the thread holding its lock
+        self.owners = dict()
+        self.contention = 0
+        self.mutex = threading.Lock()
+
+    def enable(self) -> 'Locking':
+        State.locking = self
+        Propagation.locking = self
+        return self
+
+    def disable(self):
+        if State.locking is self:
+            State.locking = None
+        if Propagation.locking is self:
+            Propagation.locking = None
+
+    def lock(self, obj) -> threading.Lock:
+        """Return the lock for a State or gate"""
+        lock = self.locks.get(obj)
+        if lock is None:
+            lock = self.locks.setdefault(obj, threading.Lock())
+        return lock
+
+    def contended(self):
+        with self.mutex:
+            self.contention += 1
+
+    def acquire(self, states: Iterable[State]) -> set:
+        """Lock states in order, blocking until each lock is free, and return the set of them"""
+        ident = threading.get_ident()
+        held = set()
+        try:
+            for state in sorted(states, key=id):
+                lock = self.lock(state)
+                if not lock.acquire(False):
+                    self.contended()
+                    if self.owners.get(state) == ident:
+                        # held by a suspended coroutine on this thread, so waiting would never end
+                        raise PropagationError('{} is being changed by a coroutine on this thread'.format(
+                            state.__name__))
+                    lock.acquire()
+                self.owners[state] = ident
+                held.add(state)
+        except:
+            self.release(held)
+            raise
+        return held
+
+    async def acquire_async(self, states: Iterable[State]) -> set:
+        """Lock states in order, polling rather than blocking, and return the set of them"""
+        ident = threading.get_ident()
+        held = set()
+        try:
+            for state in sorted(states, key=id):
+                lock = self.lock(state)
+                if not lock.acquire(False):
+                    self.contended()
+                    while not lock.acquire(False):
+                        await asyncio.sleep(self.poll)
+                self.owners[state] = ident
+                held.add(state)
+        except:
+            self.release(held)
+            raise
+        return held
+
+    def release(self, states: Iterable[State]):
+        for state in states:
+            del self.owners[state]
+            self.locks[state].release()
@@ -1,9 +1,15 @@
 import asyncio
-from aios import state
+import heapq
+from aios import state, propagation
 from typing import Dict, Any, List, Callable, Tuple
 import logging
 logger = logging.getLogger('aios.logic')
 
+def none(iterable) -> bool:
+    """True if none of the items are truthy - the opposite of any()"""
+    return not any(iterable)
+
+
 class ConditionalInputOutput(object):
     """
     >>> from aios import State
@@ -25,6 +31,29 @@ class ConditionalInputOutput(object):
     >>> A.disabled = True
     >>> print(O)
     O=[enabled, DISABLED]
+
+    The condition can be all, any, none or an int k (at least k of the inputs). These
+    keep a count of the satisfied inputs, so a change to one input is O(1) however
+    many inputs there are. Any other callable is passed a list of booleans, one per input.
+
+    Outputs are only changed when the result of the condition becomes True :-
+
+    >>> doors = [State(['open', 'closed'], name='door{}'.format(i), default='closed') for i in range(500)]
+    >>> alarm = State(['ringing', 'silent'], name='alarm', default='silent')
+    >>> gate = ConditionalInputOutput(3, [_.open for _ in doors], [alarm.ringing])
+    >>> doors[7].open = True
+    >>> doors[99].open = True
+    >>> print(alarm)
+    alarm=[ringing, SILENT]
+    >>> doors[250].open = True
+    >>> print(alarm)
+    alarm=[RINGING, silent]
+    >>> gate.satisfied, gate.result
+    (3, True)
+    >>> alarm.silent = True
+    >>> doors[400].open = True
+    >>> print(alarm)
+    alarm=[ringing, SILENT]
     """
 
     def __init__(self,
@@ -36,53 +65,111 @@ class ConditionalInputOutput(object):
         assert inputs and outputs
         assert all(map(state.State.check_state_tuple, inputs + outputs))
 
-        self.async_required = async_required = any(_[0].check_for_async() for _ in outputs)
+        self.async_required = async_required = any(_[0].async_required for _ in outputs)
 
-        logger.debug('{} has Async Required: {}'.format(condition.__name__, async_required))
+        logger.debug('{} has Async Required: {}'.format(getattr(condition, '__name__', condition), async_required))
 
         idx = 0
         self.locks = dict()
         self.states = dict()
         self.conditions = dict()
+        self.matches = []
         factory = self.output_factory_async if async_required else self.output_factory
 
         for source, source_state in inputs:
 
-            source.output_callbacks.add(factory(idx))
+            source.set_output(factory(idx))
             self.conditions[idx] = source_state
             self.states[idx] = source.current_state
             self.locks[idx] = None
+            self.matches.append(source.current_state == source_state)
             idx += 1
 
         self.inputs = inputs
         self.outputs = outputs
         self.idx = idx
+        self.satisfied = sum(self.matches)
+        self.result = None
+
+        # count based conditions are satisfied when minimum <= satisfied <= maximum
+        if condition is all:
+            self.bounds = (idx, idx)
+        elif condition is any:
+            self.bounds = (1, idx)
+        elif condition is none:
+            self.bounds = (0, 0)
+        elif type(condition) is int:
+            assert 0 < condition <= idx
+            self.bounds = (condition, idx)
+        else:
+            assert callable(condition)
+            self.bounds = None
 
         if async_required:
             asyncio.ensure_future(self.notify_change_async())
         else:
             self.notify_change()
 
-    def notify_change(self):
+    def update(self, idx: int, new_state: str):
+        """Record the new state of input idx and adjust the count of satisfied inputs"""
+        self.states[idx] = new_state
+        match = self.conditions[idx] == new_state
+        if match != self.matches[idx]:
+            self.matches[idx] = match
+            self.satisfied += 1 if match else -1
+
+    def check(self) -> bool:
+        """The result of the condition for the current inputs"""
+        if self.bounds is not None:
+            return self.bounds[0] <= self.satisfied <= self.bounds[1]
+        return self.condition(self.matches) is True
+
+    def resync(self):
+        """Recompute the result after inputs were updated directly (eg restored from a snapshot), without notifying the outputs"""
+        self.result = self.check()
 
-        states = [self.conditions[idx] == self.states[idx] for idx in range(self.idx)]
+    def evaluate(self) -> bool:
+        """Evaluate the condition, returning True only if the result has just become True"""
+        result = self.check()
 
-        logger.debug('{} notify_change with states {}'.format(self, states))
+        changed, self.result = result != self.result, result
 
-        if self.condition(states) is not True:
+        if state.State.metrics is not None:
+            state.State.metrics.gate(self, changed)
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('{} evaluated {}/{} inputs satisfied: {}'.format(self, self.satisfied, self.idx, result))
+
+        return result and changed
+
+    def input_changed(self, idx: int) -> bool:
+        """Update input idx to its locked state and evaluate the condition (under the gate's lock in thread-safe mode)"""
+        locking = state.State.locking
+        if locking is None:
+            self.update(idx, self.locks[idx])
+            return self.evaluate()
+        with locking.lock(self):
+            self.update(idx, self.locks[idx])
+            return self.evaluate()
+
+    def notify_change(self):
+
+        if not self.evaluate():
             return
+        self.notify()
 
+    def notify(self):
         #notify change to output objects
         for dest, dest_state in self.outputs:
             dest.change_state(dest_state, self)
 
     async def notify_change_async(self):
 
-        states = [self.conditions[idx] == self.states[idx] for idx in range(self.idx)]
-
-        if self.condition(states) is not True:
+        if not self.evaluate():
             return
+        await self.notify_async()
 
+    async def notify_async(self):
         #notify change to output objects
         for dest, dest_state in self.outputs:
             await dest.change_state_async(dest_state, self)
@@ -102,8 +189,8 @@ class ConditionalInputOutput(object):
                 self.parent.locks[self.idx] = new_state
 
             async def change(self):
-                self.parent.states[self.idx] = self.parent.locks[self.idx]
-                self.parent.notify_change_async()
+                if self.parent.input_changed(self.idx):
+                    await self.parent.notify_async()
 
             async def release_lock(self):
                 self.parent.locks[self.idx] = None
@@ -128,8 +215,8 @@ class ConditionalInputOutput(object):
                 self.parent.locks[self.idx] = new_state
 
             def change(self):
-                self.parent.states[self.idx] = self.parent.locks[self.idx]
-                self.parent.notify_change()
+                if self.parent.input_changed(self.idx):
+                    self.parent.notify()
 
             def release_lock(self):
                 self.parent.locks[self.idx] = None
@@ -140,23 +227,277 @@ class ConditionalInputOutput(object):
         return Output(self, idx)
 
 
+class DelayedOutput(object):
+    """Output added to the input State of a TimeBuffer link"""
+
+    def __init__(self, buffer: 'TimeBuffer', delay: float, input_state: str, output: Tuple['state.State', str]):
+        self.buffer = buffer
+        self.delay = delay
+        self.input_state = input_state
+        self.output = output
+        self.new_state = None
+        self.timer = None
+
+    def acquire_lock(self, new_state):
+        self.new_state = new_state
+
+    def change(self):
+        if self.new_state == self.input_state:
+            self.timer = self.buffer.schedule(self.delay, *self.output)
+        elif self.timer is not None:
+            # the input left the state before the delay expired
+            self.buffer.cancel(self.timer)
+            self.timer = None
+
+    def release_lock(self):
+        self.new_state = None
+
+    def require_async(self):
+        return False
+
+
 class TimeBuffer(object):
     """
+    TimeBuffer links States together with a delay - the output changes once the input
+    has been in a state for delay seconds.
+
     >>> from aios import State
     >>> A = State(['enabled', 'disabled'], name='A', default='disabled')
     >>> O = State(['enabled', 'disabled'], name='O')
     >>> tb = TimeBuffer()
-    >>> tb.add(delay=10, input=A.enabled, output=O.enabled)
+    >>> tb.add(delay=0.1, input=A.enabled, output=O.enabled)
     >>> tb.add(delay=0, input=A.disabled, output=O.disabled)
+    >>> A.enabled = True
+    >>> print(O, len(tb))
+    O=[enabled, disabled] 1
+    >>> loop = asyncio.get_event_loop()
+    >>> loop.run_until_complete(asyncio.sleep(0.2))
+    >>> print(O, len(tb))
+    O=[ENABLED, disabled] 0
 
+    Links are debounced - if the input leaves the state before the delay expires, the
+    pending change is cancelled. A delay of 0 changes the output immediately.
+
+    >>> A.disabled = True
+    >>> A.enabled = True
+    >>> A.disabled = True
+    >>> loop.run_until_complete(asyncio.sleep(0.2))
+    >>> print(O, len(tb))
+    O=[enabled, DISABLED] 0
+
+    Each output State has at most one pending change, and scheduling another one
+    supersedes it. Pending changes are kept in a single heap, ordered by when they
+    are due, with one timer on the event loop for the earliest of them. Cancelled
+    changes are marked rather than removed, so cancelling is O(1).
     """
-    def __init__(self):
+
+    def __init__(self, loop: asyncio.AbstractEventLoop=None):
 
         self.buffers = []
+        self.loop = loop
+        # heap of [when, seq, dest, dest_state] - dest is None once cancelled or done
+        self.timers = []
+        self.scheduled = dict()
+        self.cancelled = 0
+        self.seq = 0
+        self.handle = None
+
+    def __len__(self):
+        return len(self.scheduled)
 
     def add(self,
-            delay: int,
+            delay: float,
             input: Tuple['state.State', str],
             output: Tuple['state.State', str]):
-        pass
 
+        assert delay >= 0
+        assert state.State.check_state_tuple(input) and state.State.check_state_tuple(output)
+
+        source, source_state = input
+        link = DelayedOutput(self, delay, source_state, output)
+        source.set_output(link)
+        self.buffers.append(link)
+
+    def schedule(self, delay: float, dest: 'state.State', dest_state: str):
+        """Change dest to dest_state after delay seconds, superseding any pending change to dest"""
+
+        previous = self.scheduled.get(dest)
+        if previous is not None:
+            self.cancel(previous)
+
+        if delay == 0:
+            propagation.enact([(dest, dest_state)], self, self.loop)
+            return None
+
+        if self.loop is None:
+            self.loop = asyncio.get_event_loop()
+
+        when = self.loop.time() + delay
+        timer = [when, self.seq, dest, dest_state]
+        self.seq += 1
+        heapq.heappush(self.timers, timer)
+        self.scheduled[dest] = timer
+
+        if self.handle is None or when < self.handle.when():
+            self.rearm()
+
+        return timer
+
+    def cancel(self, timer: List):
+        dest = timer[2]
+        if dest is None:
+            return
+        if self.scheduled.get(dest) is timer:
+            del self.scheduled[dest]
+        timer[2] = None
+        self.cancelled += 1
+
+        if self.cancelled > 1024 and self.cancelled > len(self.timers) // 2:
+            self.timers = [_ for _ in self.timers if _[2] is not None]
+            heapq.heapify(self.timers)
+            self.cancelled = 0
+
+    def rearm(self):
+        while self.timers and self.timers[0][2] is None:
+            heapq.heappop(self.timers)
+            self.cancelled -= 1
+
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+
+        if self.timers:
+            self.handle = self.loop.call_at(self.timers[0][0], self.fire)
+
+    def fire(self):
+        self.handle = None
+        now = self.loop.time()
+
+        due = []
+        while self.timers and self.timers[0][0] <= now:
+            timer = heapq.heappop(self.timers)
+            if timer[2] is None:
+                self.cancelled -= 1
+                continue
+            del self.scheduled[timer[2]]
+            due.append((timer[2], timer[3]))
+            timer[2] = None
+
+        self.rearm()
+
+        # changes which fall due together are enacted in a single propagation
+        propagation.enact(due, self, self.loop)
+
+
+class CoalescingOutput(object):
+    """
+    Wraps an output of a State so that a slow output only ever gets the latest state.
+
+    The State changes without waiting for the wrapped output. While the output is busy
+    with a change, later transitions collapse into the newest one, which the output gets
+    once it's free - so the work done by the output is bounded by how fast it is rather
+    than by how often the State changes. min_interval (in seconds) also limits how often
+    the output is changed.
+
+    >>> from aios import State
+    >>> class Modem(object):
+    ...     def __init__(self):
+    ...         self.changes = []
+    ...     async def acquire_lock(self, new_state):
+    ...         self.new_state = new_state
+    ...     async def change(self):
+    ...         await asyncio.sleep(0.05)
+    ...         self.changes.append(self.new_state)
+    ...     async def release_lock(self): pass
+    ...     def require_async(self): return True
+    >>> connectivity = State(['online', 'offline'], name='connectivity', default='offline')
+    >>> modem = Modem()
+    >>> output = CoalescingOutput(modem)
+    >>> connectivity.set_output(output)
+    >>> async def flap():
+    ...     for _ in range(20):
+    ...         connectivity.online = True
+    ...         await asyncio.sleep(0.005)
+    ...         connectivity.offline = True
+    ...         await asyncio.sleep(0.005)
+    ...     connectivity.online = True
+    ...     await asyncio.sleep(0.2)
+    >>> loop = asyncio.get_event_loop()
+    >>> loop.run_until_complete(flap())
+    >>> len(modem.changes) < 10, modem.changes[-1]
+    (True, 'online')
+    >>> output.coalesced > 30
+    True
+
+    The wrapper itself doesn't require async, so the State can still be changed with
+    change_state. The wrapped output can't refuse a change - an exception from any of
+    its calls is logged, and the next state is still sent.
+    """
+
+    def __init__(self, output, min_interval: float=0, loop: asyncio.AbstractEventLoop=None):
+        self.output = output
+        self.min_interval = min_interval
+        self.loop = loop
+        self.new_state = None
+        # the newest state not yet sent to the output, and the last one sent
+        self.latest = None
+        self.sent = None
+        # loop time when the last change was sent to the output
+        self.last = None
+        self.task = None
+        # transitions which were superseded before being sent
+        self.coalesced = 0
+
+    def acquire_lock(self, new_state):
+        self.new_state = new_state
+
+    def change(self):
+        if self.latest is not None:
+            self.coalesced += 1
+        self.latest = self.new_state
+        if self.task is None:
+            if self.loop is None:
+                self.loop = asyncio.get_event_loop()
+            self.task = self.loop.create_task(self.run())
+
+    def release_lock(self):
+        self.new_state = None
+
+    def require_async(self):
+        return False
+
+    async def run(self):
+        try:
+            while self.latest is not None:
+                if self.min_interval and self.last is not None:
+                    wait = self.last + self.min_interval - self.loop.time()
+                    if wait > 0:
+                        await asyncio.sleep(wait)
+
+                new_state, self.latest = self.latest, None
+                if new_state == self.sent:
+                    # flapped back to the state the output already has
+                    continue
+                self.last = self.loop.time()
+                try:
+                    await self.send(new_state)
+                    self.sent = new_state
+                except Exception:
+                    logger.exception('{} failed to change to {}'.format(self.output, new_state))
+        finally:
+            self.task = None
+
+    async def send(self, new_state: str):
+        output = self.output
+        if output.require_async():
+            await output.acquire_lock(new_state)
+            try:
+                await output.change()
+            finally:
+                await output.release_lock()
+        else:
+            output.acquire_lock(new_state)
+            try:
+                output.change()
+            finally:
+                output.release_lock()
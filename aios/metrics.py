@@ -0,0 +1,310 @@
+import asyncio
+import bisect
+import logging
+import time
+from typing import Dict, List, Tuple
+
+from aios.state import State, _blocking
+
+logger = logging.getLogger('aios.metrics')
+
+LATENCY_BUCKETS = (1e-6, 5e-6, 1e-5, 5e-5, 1e-4, 5e-4, 1e-3, 5e-3, 1e-2, 5e-2, 0.1, 0.5, 1.0, 5.0)
+FANOUT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+PHASES = ('acquire_lock', 'change', 'release_lock')
+
+
+class Histogram(object):
+    """
+    A histogram with fixed bucket upper bounds
+
+    >>> h = Histogram((1, 5, 10))
+    >>> for _ in (0.5, 3, 3, 7, 50):
+    ...     h.observe(_)
+    >>> h.count, h.sum, h.cumulative()
+    (5, 63.5, [(1, 1), (5, 3), (10, 4), ('+Inf', 5)])
+    """
+
+    __slots__ = ('bounds', 'counts', 'count', 'sum')
+
+    def __init__(self, bounds: Tuple=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self) -> List[Tuple]:
+        total = 0
+        buckets = []
+        for bound, count in zip(self.bounds + ('+Inf',), self.counts):
+            total += count
+            buckets.append((bound, total))
+        return buckets
+
+    def snapshot(self) -> Dict:
+        return dict(count=self.count, sum=self.sum, buckets=self.cumulative())
+
+
+class TimedOutput(object):
+    """Wraps a sync output of a State, recording the latency of each call"""
+
+    __slots__ = ('output', 'metrics', 'state')
+
+    def __init__(self, output, metrics: 'Metrics', state: State):
+        self.output = output
+        self.metrics = metrics
+        self.state = state
+
+    def require_async(self):
+        return self.output.require_async()
+
+    def blocking(self):
+        return _blocking(self.output)
+
+    def acquire_lock(self, new_state):
+        start = time.perf_counter()
+        try:
+            self.output.acquire_lock(new_state)
+        except:
+            self.metrics.reject(self.state)
+            raise
+        finally:
+            self.metrics.observe(self.state, self.output, 'acquire_lock', time.perf_counter() - start)
+
+    def change(self):
+        start = time.perf_counter()
+        try:
+            self.output.change()
+        finally:
+            self.metrics.observe(self.state, self.output, 'change', time.perf_counter() - start)
+
+    def release_lock(self):
+        start = time.perf_counter()
+        try:
+            self.output.release_lock()
+        finally:
+            self.metrics.observe(self.state, self.output, 'release_lock', time.perf_counter() - start)
+
+
+class TimedAsyncOutput(TimedOutput):
+    """Wraps an async output of a State, recording the latency of each call"""
+
+    __slots__ = ()
+
+    async def acquire_lock(self, new_state):
+        start = time.perf_counter()
+        try:
+            await self.output.acquire_lock(new_state)
+        except:
+            self.metrics.reject(self.state)
+            raise
+        finally:
+            self.metrics.observe(self.state, self.output, 'acquire_lock', time.perf_counter() - start)
+
+    async def change(self):
+        start = time.perf_counter()
+        try:
+            await self.output.change()
+        finally:
+            self.metrics.observe(self.state, self.output, 'change', time.perf_counter() - start)
+
+    async def release_lock(self):
+        start = time.perf_counter()
+        try:
+            await self.output.release_lock()
+        finally:
+            self.metrics.observe(self.state, self.output, 'release_lock', time.perf_counter() - start)
+
+
+def label(obj) -> str:
+    """The name used for a State, output or gate in metrics"""
+    if isinstance(obj, State):
+        parent = getattr(obj, '__parent__', None)
+        if parent is not None:
+            return '{}.{}'.format(parent._aios_qualified_name(), obj.__name__)
+    return getattr(obj, '__name__', None) or type(obj).__name__
+
+
+class Metrics(object):
+    """
+    Metrics records transition counts, lock rejections, fan-out and the latency of each
+    phase of each output, for every State, and the latency of transitions by priority
+    (from the start of their propagation), once enabled.
+
+    >>> from aios import State
+    >>> class GPIO(object):
+    ...     def __init__(self):
+    ...         self._lock = None
+    ...     def acquire_lock(self, new_state):
+    ...         if self._lock is not None:
+    ...             raise Exception('Change not allowed')
+    ...         self._lock = new_state
+    ...     def change(self): pass
+    ...     def release_lock(self):
+    ...         self._lock = None
+    ...     def require_async(self):
+    ...         return False
+    >>> relay = State(['on', 'off'], name='relay', default='off')
+    >>> gpio = GPIO()
+    >>> relay.set_output(gpio)
+    >>> metrics = Metrics().enable()
+    >>> relay.on = True
+    >>> relay.off = True
+    >>> gpio._lock = 'busy'
+    >>> relay.on = True
+    Traceback (most recent call last):
+    ...
+    Exception: Change not allowed
+    >>> metrics.disable()
+    >>> snapshot = metrics.snapshot()
+    >>> snapshot['transitions'], snapshot['rejections']
+    ({'relay': 2}, {'relay': 1})
+    >>> latency = snapshot['latency'][('relay', 'GPIO', 'acquire_lock')]
+    >>> latency['count']
+    3
+    >>> snapshot['priorities'][0]['count']
+    2
+    >>> print(metrics.prometheus())
+    # TYPE aios_transitions_total counter
+    aios_transitions_total{state="relay"} 2
+    # TYPE aios_lock_rejections_total counter
+    aios_lock_rejections_total{state="relay"} 1
+    ...
+    aios_output_latency_seconds_count{state="relay",output="GPIO",phase="change"} 2
+    ...
+
+    While disabled, the only cost to a transition is checking State.metrics. serve()
+    starts an HTTP server on the event loop which returns prometheus() to any request.
+    """
+
+    def __init__(self, latency_buckets: Tuple=LATENCY_BUCKETS, fanout_buckets: Tuple=FANOUT_BUCKETS):
+        self.latency_buckets = latency_buckets
+        self.transitions = dict()
+        self.rejections = dict()
+        self.fanout = Histogram(fanout_buckets)
+        # (State, output, phase) -> Histogram
+        self.latency = dict()
+        # gate -> [evaluations, changes of result]
+        self.gates = dict()
+        # priority -> Histogram of the time from the start of a propagation until each transition
+        self.priorities = dict()
+
+    def enable(self) -> 'Metrics':
+        State.metrics = self
+        State.observers.append(self.transition)
+        return self
+
+    def disable(self):
+        if State.metrics is self:
+            State.metrics = None
+        if self.transition in State.observers:
+            State.observers.remove(self.transition)
+
+    def wrap(self, state: State, outputs) -> List[TimedOutput]:
+        return [(TimedAsyncOutput if _.require_async() else TimedOutput)(_, self, state) for _ in outputs]
+
+    def transition(self, state: State, old: int, new: int):
+        self.transitions[state] = self.transitions.get(state, 0) + 1
+        self.fanout.observe(len(state._outputs or ()) + len(state.downstream(state.schema.states[new])))
+
+    def reject(self, state: State):
+        self.rejections[state] = self.rejections.get(state, 0) + 1
+
+    def observe(self, state: State, output, phase: str, seconds: float):
+        key = (state, output, phase)
+        histogram = self.latency.get(key)
+        if histogram is None:
+            histogram = self.latency[key] = Histogram(self.latency_buckets)
+        histogram.observe(seconds)
+
+    def enacted(self, priority: int, seconds: float):
+        histogram = self.priorities.get(priority)
+        if histogram is None:
+            histogram = self.priorities[priority] = Histogram(self.latency_buckets)
+        histogram.observe(seconds)
+
+    def gate(self, gate, changed: bool):
+        counts = self.gates.get(gate)
+        if counts is None:
+            counts = self.gates[gate] = [0, 0]
+        counts[0] += 1
+        counts[1] += changed
+
+    def snapshot(self) -> Dict:
+        """Return the metrics as a dict, with States, outputs and gates by label"""
+        return dict(
+            transitions={label(k): v for k, v in self.transitions.items()},
+            rejections={label(k): v for k, v in self.rejections.items()},
+            fanout=self.fanout.snapshot(),
+            latency={(label(state), label(output), phase): _.snapshot()
+                     for (state, output, phase), _ in self.latency.items()},
+            gates={label(k): dict(evaluations=v[0], changes=v[1]) for k, v in self.gates.items()},
+            priorities={k: v.snapshot() for k, v in sorted(self.priorities.items())},
+        )
+
+    def prometheus(self) -> str:
+        """Return the metrics in the Prometheus text exposition format"""
+        lines = []
+
+        def counter(name, values, label_name):
+            lines.append('# TYPE {} counter'.format(name))
+            for key, value in values.items():
+                lines.append('{}{{{}="{}"}} {}'.format(name, label_name, _escape(label(key)), value))
+
+        def histogram(name, h, labels):
+            for bound, count in h.cumulative():
+                lines.append('{}_bucket{{{}le="{}"}} {}'.format(name, labels, bound, count))
+            braces = '{{{}}}'.format(labels.rstrip(',')) if labels else ''
+            lines.append('{}_sum{} {}'.format(name, braces, h.sum))
+            lines.append('{}_count{} {}'.format(name, braces, h.count))
+
+        counter('aios_transitions_total', self.transitions, 'state')
+        counter('aios_lock_rejections_total', self.rejections, 'state')
+
+        lines.append('# TYPE aios_fanout histogram')
+        histogram('aios_fanout', self.fanout, '')
+
+        lines.append('# TYPE aios_output_latency_seconds histogram')
+        for (state, output, phase), h in sorted(self.latency.items(), key=lambda _: (label(_[0][0]), PHASES.index(_[0][2]))):
+            histogram('aios_output_latency_seconds', h, 'state="{}",output="{}",phase="{}",'.format(
+                _escape(label(state)), _escape(label(output)), phase))
+
+        lines.append('# TYPE aios_transition_latency_seconds histogram')
+        for priority, h in sorted(self.priorities.items()):
+            histogram('aios_transition_latency_seconds', h, 'priority="{}",'.format(priority))
+
+        lines.append('# TYPE aios_gate_evaluations_total counter')
+        for gate, (evaluations, changes) in self.gates.items():
+            lines.append('aios_gate_evaluations_total{{gate="{}"}} {}'.format(_escape(label(gate)), evaluations))
+        lines.append('# TYPE aios_gate_changes_total counter')
+        for gate, (evaluations, changes) in self.gates.items():
+            lines.append('aios_gate_changes_total{{gate="{}"}} {}'.format(_escape(label(gate)), changes))
+
+        return '\n'.join(lines)
+
+    async def serve(self, host: str='127.0.0.1', port: int=9100):
+        """Serve prometheus() over HTTP, returning the asyncio Server"""
+
+        async def handle(reader, writer):
+            try:
+                await reader.readuntil(b'\r\n\r\n')
+                body = (self.prometheus() + '\n').encode()
+                writer.write(b'HTTP/1.0 200 OK\r\n'
+                             b'Content-Type: text/plain; version=0.0.4\r\n'
+                             b'Content-Length: ' + str(len(body)).encode() + b'\r\n\r\n' + body)
+                await writer.drain()
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                pass
+            finally:
+                writer.close()
+
+        return await asyncio.start_server(handle, host, port)
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -1,4 +1,5 @@
-import logging, inspect
+import fnmatch, logging, inspect
+from typing import Callable, Dict, List
 logger = logging.getLogger('aios.object')
 
 from .state import State
@@ -85,11 +86,20 @@ class Object(object):
     def __new__(cls, *args, **kwargs):
         o = super().__new__(cls)
 
-        setattr(o, '__name__', kwargs.pop('name', cls.__name__))
-        setattr(o, '_aios_children', {})
-        for name, obj in  kwargs.pop('children', {}).items():
+        object.__setattr__(o, '__name__', kwargs.pop('name', cls.__name__))
+        object.__setattr__(o, '_aios_children', {})
+        # caches - see _aios_cached
+        object.__setattr__(o, '_aios_key', None)
+        object.__setattr__(o, '_aios_qualname', None)
+        object.__setattr__(o, '_aios_path', None)
+        object.__setattr__(o, '_aios_root', None)
+        object.__setattr__(o, '_aios_index', None)
+        # name -> factory for children created on first access - see _aios_add_lazy
+        object.__setattr__(o, '_aios_lazy', None)
+        children = kwargs.pop('children', None)
+        if children:
             #all children are already instances
-            o._aios_add_child(name, obj)
+            o._aios_add_children(children)
 
         return o
 
@@ -104,6 +114,107 @@ class Object(object):
         setattr(self, name, obj)
         self._aios_children[name] = obj
 
+        if isinstance(obj, Object):
+            object.__setattr__(obj, '_aios_key', name)
+            object.__setattr__(obj, '_aios_index', None)
+            obj._aios_invalidate('_aios_qualname', '_aios_path', '_aios_root')
+        self._aios_index_children({name: obj})
+
+    def _aios_add_children(self, children: Dict):
+        """
+        Add several children at once - like _aios_add_child, but checking the names
+        together and setting the attributes directly
+
+        >>> from aios import State
+        >>> site = Object(name='site')
+        >>> site._aios_add_children({'b{}'.format(_): Object() for _ in range(3)})
+        >>> site.b2
+        <site.b2>
+        >>> site._aios_add_children({'b1': Object()})
+        Traceback (most recent call last):
+        ...
+        Exception: An object named "b1" was already defined on "site"
+        """
+        lazy = self._aios_lazy or ()
+        cls = type(self)
+        for name in children:
+            if name in self.__dict__ or name in lazy or hasattr(cls, name):
+                raise Exception('An object named "{}" was already defined on "{}"'.format(name, self.__name__))
+
+        for name, obj in children.items():
+            object.__setattr__(obj, '__parent__', self)
+            object.__setattr__(obj, '__name__', name)
+            object.__setattr__(self, name, obj)
+            if isinstance(obj, Object):
+                object.__setattr__(obj, '_aios_key', name)
+                object.__setattr__(obj, '_aios_index', None)
+                caches = obj.__dict__
+                if caches['_aios_qualname'] is not None or caches['_aios_path'] is not None or \
+                        caches['_aios_root'] is not None:
+                    obj._aios_invalidate('_aios_qualname', '_aios_path', '_aios_root')
+        self._aios_children.update(children)
+        self._aios_index_children(children)
+
+    def _aios_add_lazy(self, name: str, factory: Callable):
+        """
+        Add a child which is created by factory() the first time it's used - by attribute
+        access, _aios_lookup, _aios_find or anything which walks the hierarchy
+
+        >>> built = []
+        >>> def build():
+        ...     built.append('b1')
+        ...     return Object()
+        >>> site = Object(name='site')
+        >>> site._aios_add_lazy('b1', build)
+        >>> site
+        <site <site.b1 (lazy)>>
+        >>> built
+        []
+        >>> site.b1
+        <site.b1>
+        >>> built, site.b1 is site.b1
+        (['b1'], True)
+        """
+        if name in self.__dict__ or name in (self._aios_lazy or ()) or hasattr(type(self), name):
+            raise Exception('An object named "{}" was already defined on "{}"'.format(name, self.__name__))
+        if self._aios_lazy is None:
+            object.__setattr__(self, '_aios_lazy', dict())
+        self._aios_lazy[name] = factory
+
+    def _aios_expand(self):
+        """Create any lazy children of this object, in the order they were added"""
+        lazy = self._aios_lazy
+        if lazy:
+            children = {name: factory() for name, factory in lazy.items()}
+            object.__setattr__(self, '_aios_lazy', None)
+            self._aios_add_children(children)
+
+    def __getattr__(self, item):
+        # only called when item isn't found - create it if it's a lazy child
+        lazy = self.__dict__.get('_aios_lazy')
+        if lazy is None or item not in lazy:
+            raise AttributeError("'{}' object has no attribute '{}'".format(type(self).__name__, item))
+        obj = lazy.pop(item)()
+        self._aios_add_children({item: obj})
+        return obj
+
+    def _aios_index_children(self, children: Dict):
+        """Add new children to the path index of the root, if it has been built"""
+
+        # not cached here, so building a hierarchy bottom up doesn't create caches to invalidate
+        root = self
+        while '__parent__' in root.__dict__:
+            root = root.__dict__['__parent__']
+        index = root._aios_index
+        if index is not None:
+            prefix = self._aios_cached('_aios_path', _path)
+            for name, obj in children.items():
+                path = '{}.{}'.format(prefix, name) if prefix else name
+                index[path] = obj
+                if isinstance(obj, Object):
+                    for sub_path, node in obj._aios_walk(expand=False):
+                        index['{}.{}'.format(path, sub_path)] = node
+
     def _aios_state_init(self):
         for name, obj in getattr(self, '_aios_children', {}).items():
             if hasattr(obj, '_aios_child_init') and callable(obj._aios_child_init):
@@ -111,6 +222,214 @@ class Object(object):
                 obj._aios_state_init()
         return self
 
+    def _aios_cached(self, attr: str, compute):
+        """
+        Return a cached attribute which is computed from the same attribute of the parent
+        (compute(node, parent_value), where parent_value is None for the top object)
+
+        If an attribute is cached on an object, it is also cached on all of its parents, so
+        _aios_invalidate only has to visit the part of the hierarchy where it is cached.
+        """
+        branch = []
+        node = self
+        while True:
+            value = node.__dict__[attr]
+            if value is not None:
+                break
+            branch.append(node)
+            node = node.__dict__.get('__parent__')
+            if node is None:
+                break
+
+        for node in reversed(branch):
+            value = compute(node, value)
+            object.__setattr__(node, attr, value)
+        return value
+
+    def _aios_invalidate(self, *attrs):
+        pending = [self]
+        while pending:
+            node = pending.pop()
+            if all(node.__dict__[_] is None for _ in attrs):
+                continue
+            for _ in attrs:
+                object.__setattr__(node, _, None)
+            pending.extend(_ for _ in node._aios_children.values() if isinstance(_, Object))
+
+    def _aios_walk(self, expand: bool=True):
+        """Yield (path, object) for every child object and State below this object (creating lazy children unless expand=False)"""
+        pending = [('', self)]
+        while pending:
+            prefix, node = pending.pop()
+            if expand and node._aios_lazy:
+                node._aios_expand()
+            for name, obj in node._aios_children.items():
+                path = '{}.{}'.format(prefix, name) if prefix else name
+                yield path, obj
+                if isinstance(obj, Object):
+                    pending.append((path, obj))
+
+    def _aios_qualified_name(self) -> str:
+        """
+        The dotted names of the branch down to this object, as used by __repr__ - cached
+        until an object in the branch is renamed or moved
+
+        >>> system = Object(name='iot', children={'endpoint': Object(children={'relay': Object()})})
+        >>> system.endpoint.relay._aios_qualified_name()
+        'iot.endpoint.relay'
+        >>> system.endpoint.__name__ = 'ep1'
+        >>> system.endpoint.relay._aios_qualified_name()
+        'iot.ep1.relay'
+        """
+        return self._aios_cached('_aios_qualname', _qualname)
+
+    def _aios_lookup(self, path: str):
+        """
+        Return the object or State at a dotted path of child names below this object.
+
+        Lookups use an index of every path in the hierarchy, which is built on first use
+        and then kept up to date by _aios_add_child. Lazy children aren't indexed until
+        they are created, which a lookup of a path through them does.
+
+        >>> from aios import State
+        >>> site = Object(name='site', children={
+        ...     'b1': Object(children={'door': State(['open', 'closed'])}),
+        ...     'b2': Object(children={'door': State(['open', 'closed']), 'window': State(['open', 'closed'])})})
+        >>> site._aios_lookup('b2.door')
+        door=[open, closed]
+        >>> site.b2._aios_lookup('window') is site.b2.window
+        True
+        >>> site.b1._aios_add_child('window', State(['open', 'closed']))
+        >>> site._aios_lookup('b1.window') is site.b1.window
+        True
+        >>> site._aios_lookup('b3')
+        Traceback (most recent call last):
+        ...
+        KeyError: 'b3'
+        """
+        root = self._aios_cached('_aios_root', _root)
+        index = root._aios_index
+        if index is None:
+            index = {path: obj for path, obj in root._aios_walk(expand=False)}
+            index[''] = root
+            object.__setattr__(root, '_aios_index', index)
+
+        prefix = self._aios_cached('_aios_path', _path)
+        try:
+            return index['{}.{}'.format(prefix, path) if prefix and path else prefix or path]
+        except KeyError:
+            pass
+
+        # the path may go through lazy children
+        node = self
+        for name in path.split('.'):
+            child = node._aios_children.get(name) if isinstance(node, Object) else None
+            if child is None and isinstance(node, Object) and name in (node._aios_lazy or ()):
+                child = getattr(node, name)
+            if child is None:
+                raise KeyError(path)
+            node = child
+        return node
+
+    def _aios_find(self, pattern: str) -> List:
+        """
+        Return the objects and States matching a dotted pattern of child names below this
+        object. Each part of the pattern can use * ? and [] as in fnmatch, and a final **
+        matches everything below.
+
+        >>> from aios import State
+        >>> site = Object(name='site', children={
+        ...     'b1': Object(children={'door': State(['open', 'closed'])}),
+        ...     'b2': Object(children={'door': State(['open', 'closed']), 'window': State(['open', 'closed'])})})
+        >>> site._aios_find('*.door')
+        [door=[open, closed], door=[open, closed]]
+        >>> sorted(_.__name__ for _ in site._aios_find('b2.**'))
+        ['door', 'window']
+
+        The work done is proportional to the number of children at the levels with wildcards,
+        rather than to the size of the hierarchy.
+        """
+        segments = pattern.split('.')
+        nodes = [self]
+        for idx, segment in enumerate(segments):
+            if segment == '**':
+                assert idx == len(segments) - 1, '** is only supported at the end of a pattern'
+                return [obj for node in nodes for _, obj in node._aios_walk()]
+
+            literal = not any(_ in segment for _ in '*?[')
+            matched = []
+            for node in nodes:
+                if not isinstance(node, Object):
+                    continue
+                if node._aios_lazy:
+                    if literal:
+                        getattr(node, segment, None)
+                    else:
+                        node._aios_expand()
+                children = node._aios_children
+                if literal:
+                    if segment in children:
+                        matched.append(children[segment])
+                else:
+                    matched.extend(obj for name, obj in children.items() if fnmatch.fnmatchcase(name, segment))
+            nodes = matched
+        return nodes
+
+    def _aios_changes(self, maxsize: int=1000, policy: str='drop-oldest'):
+        """
+        Return an async iterator of the changes to every State below this object - see
+        aios.stream.Subscription
+
+        >>> import asyncio
+        >>> from aios import State
+        >>> site = Object(name='site', children={
+        ...     'b1': Object(children={'door': State(['open', 'closed'], default='closed')}),
+        ...     'b2': Object(children={'door': State(['open', 'closed'], default='closed')})})
+        >>> changes = site.b2._aios_changes()
+        >>> site.b1.door.open = True
+        >>> site.b2.door.open = True
+        >>> changes.close()
+        >>> async def read_all():
+        ...     return [(_.state.__parent__._aios_qualified_name(), _.new) async for _ in changes]
+        >>> asyncio.get_event_loop().run_until_complete(read_all())
+        [('site.b2', 'open')]
+        """
+        from aios.stream import Subscription
+        return Subscription(self, maxsize, policy)
+
+    def _aios_snapshot(self, filename: str) -> int:
+        """
+        Save the current state of every State below this object to a file - see aios.snapshot
+
+        >>> import os, tempfile
+        >>> from aios import State
+        >>> def build():
+        ...     return Object(name='site', children={
+        ...         'b{}'.format(b): Object(children={'door': State(['open', 'closed'])}) for b in range(3)})
+        >>> site = build()
+        >>> site.b0.door.open = True
+        >>> site.b2.door.closed = True
+        >>> filename = os.path.join(tempfile.mkdtemp(), 'site.snapshot')
+        >>> site._aios_snapshot(filename)
+        3
+
+        _aios_restore reads it back (through mmap), by default without calling the outputs
+        of the States. It returns the number of States which changed.
+
+        >>> site = build()
+        >>> site._aios_restore(filename)
+        2
+        >>> print(site)
+        <site <site.b0 door=[OPEN, closed]> <site.b1 door=[open, closed]> <site.b2 door=[open, CLOSED]>>
+        >>> os.remove(filename)
+        """
+        from aios import snapshot
+        return snapshot.snapshot(self, filename)
+
+    def _aios_restore(self, filename: str, outputs: bool=False) -> int:
+        from aios import snapshot
+        return snapshot.restore(self, filename, outputs)
+
     def __branch__(self):
         _=[]
         parent = self
@@ -123,9 +442,11 @@ class Object(object):
                 return _
 
     def __repr__(self):
-        names = map(lambda _:_.__name__, self.__branch__())
-        states = ' '.join(map(lambda _:_.__repr__(), self._aios_children.values()))
-        return '<{}{}>'.format('.'.join(names), (' ' if states else '') + states)
+        name = self._aios_qualified_name()
+        # lazy children are shown without creating them
+        states = ' '.join([_.__repr__() for _ in self._aios_children.values()] +
+                          ['<{}.{} (lazy)>'.format(name, _) for _ in self._aios_lazy or ()])
+        return '<{}{}>'.format(name, (' ' if states else '') + states)
 
     def __setattr__(self, attr, val):
         """capture attribute assignment of instance variables"""
@@ -140,6 +461,22 @@ class Object(object):
                 obj.__set__(self, val)
             else:
                 object.__setattr__(self, attr, val)
+                if attr == '__name__':
+                    self._aios_invalidate('_aios_qualname')
+
+
+def _qualname(node, parent):
+    return node.__name__ if parent is None else '{}.{}'.format(parent, node.__name__)
+
+
+def _path(node, parent):
+    if parent is None:
+        return ''
+    return '{}.{}'.format(parent, node._aios_key) if parent else node._aios_key
+
+
+def _root(node, parent):
+    return node if parent is None else parent
 
 
 
@@ -0,0 +1,544 @@
+import asyncio
+import collections
+import contextvars
+import heapq
+import logging
+import time
+
+logger = logging.getLogger('aios.propagation')
+
+_active = contextvars.ContextVar('aios_propagation', default=None)
+
+
+class PropagationError(Exception):
+    pass
+
+
+class TransitionCancelled(PropagationError):
+    """Raised by change_state_async when its transition is cancelled - see CancelToken"""
+    pass
+
+
+class FrozenError(Exception):
+    """Raised when changing the links or outputs of a frozen State - see aios.frozen"""
+    pass
+
+
+class Plan(object):
+    """
+    The transitions a change would propagate to - see State.plan. transitions is a tuple of
+    (State, new_state) in the order they'd be applied, and locks a tuple of (output, new_state)
+    for each acquire_lock call, in order.
+    """
+
+    __slots__ = ('transitions', 'locks')
+
+    def __init__(self, transitions: tuple, locks: tuple):
+        self.transitions = transitions
+        self.locks = locks
+
+    def __repr__(self):
+        return '<Plan {}>'.format(' '.join('{}={}'.format(getattr(state, '__name__', state), new_state)
+                                           for state, new_state in self.transitions))
+
+
+class CancelToken(object):
+    """
+    CancelToken cancels an async propagation, and everything downstream of it - see
+    State.change_state_async. The propagation's outputs are cancelled at their next
+    await, their locks released through release_lock, and the change_state_async call
+    raises TransitionCancelled. States already changed stay changed.
+    """
+
+    def __init__(self):
+        self.cancelled = False
+        # the task running the propagation
+        self.task = None
+
+    def cancel(self):
+        self.cancelled = True
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+
+    async def wait(self):
+        """Wait until the propagation has finished (eg rolled back after being cancelled)"""
+        if self.task is not None:
+            await asyncio.wait([self.task])
+
+
+def _bands(nodes):
+    """Split planned nodes into runs of consecutive nodes with the same priority"""
+    band = []
+    for node in nodes:
+        if band and node[4] != band[-1][4]:
+            yield band
+            band = []
+        band.append(node)
+    if band:
+        yield band
+
+
+class Propagation(object):
+    """
+    Propagation runs a set of state changes and everything downstream of them
+    (via State.set_input) from an explicit queue rather than by recursion.
+
+    Each round first plans the closure of the pending changes breadth-first
+    (without side effects), then locks the outputs of the planned States and applies
+    each transition in order - if any lock is refused, the locks already acquired
+    are released and nothing in the round changes. Changes requested while a propagation is running (eg by an
+    output's change()) are queued and handled in the next round, so long chains
+    propagate with constant stack depth :-
+
+    >>> from aios import State
+    >>> relays = [State(['on', 'off'], name='relay{}'.format(i), default='off') for i in range(5000)]
+    >>> for prev, relay in zip(relays, relays[1:]):
+    ...     relay.on = prev.on
+    >>> relays[0].on = True
+    >>> print(relays[-1])
+    relay4999=[ON, off]
+
+    A State which is changed again by its own downstream changes is a cycle, and
+    raises an error rather than oscillating forever :-
+
+    >>> A = State(['open', 'closed'], name='A', default='closed')
+    >>> B = State(['on', 'off'], name='B', default='off')
+    >>> B.on = A.open
+    >>> A.closed = B.on
+    >>> A.open = True
+    Traceback (most recent call last):
+    ...
+    aios.propagation.PropagationError: Cycle detected: A -> closed (Source: B)
+
+    When the links have priorities (see State.set_input), each run of planned transitions
+    with the same priority is locked and applied before the next run is locked, so a
+    critical change doesn't wait for the locks of every low priority listener. If a lock
+    is refused, only the transitions in that run are rolled back :-
+
+    >>> import asyncio, time
+    >>> class Display(object):
+    ...     async def acquire_lock(self, new_state): await asyncio.sleep(0.01)
+    ...     async def change(self): pass
+    ...     async def release_lock(self): pass
+    ...     def require_async(self): return True
+    >>> class Siren(Display):
+    ...     async def change(self): self.sounded = time.perf_counter()
+    >>> alarm = State(['on', 'off'], name='alarm', default='off')
+    >>> siren = State(['on', 'off'], name='siren', default='off')
+    >>> siren.set_output(Siren())
+    >>> siren.set_input(dict(on=alarm.on), priority=10)
+    >>> for i in range(50):
+    ...     ui = State(['on', 'off'], name='ui{}'.format(i), default='off')
+    ...     ui.set_output(Display())
+    ...     ui.set_input(dict(on=alarm.on))
+    >>> started = time.perf_counter()
+    >>> asyncio.get_event_loop().run_until_complete(alarm.change_state_async('on'))
+    >>> siren.output_callbacks[0].sounded - started < 0.2, time.perf_counter() - started > 0.4
+    (True, True)
+
+    Cycles which settle (A.open -> B.on -> A.open) are fine. Propagation also stops
+    with an error after max_steps transitions, which can be set on the class or
+    passed in when creating a Propagation.
+
+    concurrent, timeout, deadline and token are used by run_async - see
+    State.change_state_async. An output can find the deadline (in event loop time)
+    of the transition it's part of from Propagation.active().deadline.
+
+    Once thread-safe mode is enabled (see aios.locking), each round locks every State
+    visited while planning before applying the changes.
+    """
+
+    max_steps = 100000
+
+    # set by aios.locking.Locking.enable
+    locking = None
+
+    # set by aios.journal.Journal.enable
+    journal = None
+
+    # State -> CancelToken of the async propagation last started on it with supersede
+    inflight = dict()
+
+    def __init__(self, max_steps: int=None, concurrent: bool=False, timeout: float=None,
+                 deadline: float=None, token: CancelToken=None):
+        if max_steps is not None:
+            self.max_steps = max_steps
+        self.concurrent = concurrent
+        self.timeout = timeout
+        self.deadline = deadline
+        self.token = token
+        self.pending = collections.deque()
+        self.steps = 0
+        self.running = False
+        self.started = None
+        # the FrozenGraph the last plan came from, if any - see aios.frozen
+        self.graph = None
+
+    @staticmethod
+    def active():
+        """Return the Propagation currently running in this context, if any"""
+        propagation = _active.get()
+        if propagation is not None and propagation.running:
+            return propagation
+        return None
+
+    def add(self, state, new_state: str, source=None, priority: int=0):
+        self.pending.append((state, new_state, source, None, priority))
+        return self
+
+    def plan(self, visited: set=None):
+        """
+        Consume the pending changes and return an ordered dict of State -> node,
+        where node is (state, new_state, source, parent, priority) for the last
+        transition planned for that State. Every State looked at is added to visited,
+        if given.
+
+        Changes are planned (and so applied) in priority order - higher priority
+        first, then breadth first. The priority of a change is the priority of the
+        link to it (see State.set_input), or else that of the change which caused it.
+        """
+        self.graph = graph = self.frozen()
+        if graph is not None:
+            return graph.plan(self, visited)
+
+        planned = collections.OrderedDict()
+        queue, self.pending = self.pending, collections.deque()
+        # heap of (-priority, seq, node) for nodes with a priority other than 0
+        prioritised = []
+        seq = 0
+
+        while queue or prioritised:
+            if prioritised and (prioritised[0][0] < 0 or not queue):
+                node = heapq.heappop(prioritised)[2]
+            else:
+                node = queue.popleft()
+            state, new_state, source, parent, priority = node
+            assert new_state in state.states
+            if visited is not None:
+                visited.add(state)
+
+            if state in planned:
+                if planned[state][1] == new_state:
+                    continue
+                # Changed twice in one pass - a cycle if it descends from its own change
+                ancestor = parent
+                while ancestor is not None:
+                    if ancestor[0] is state:
+                        raise PropagationError('Cycle detected: {} -> {} (Source: {})'.format(
+                            state.__name__, new_state, getattr(source, '__name__', source)))
+                    ancestor = ancestor[3]
+            elif new_state == state.current_state:
+                continue
+
+            self.steps += 1
+            if self.steps > self.max_steps:
+                raise PropagationError('Propagation exceeded {} steps'.format(self.max_steps))
+
+            planned[state] = node
+            priorities = state._priorities
+            for dest, dest_state in state.downstream(new_state):
+                link = priority if priorities is None else priorities.get((new_state, dest, dest_state), priority)
+                if link:
+                    heapq.heappush(prioritised, (-link, seq, (dest, dest_state, state, node, link)))
+                    seq += 1
+                else:
+                    queue.append((dest, dest_state, state, node, 0))
+
+        return planned
+
+    def frozen(self):
+        """Return the FrozenGraph of the pending changes, if they are all in the same one"""
+        graph = None
+        for node in self.pending:
+            frozen = node[0]._frozen
+            if frozen is None or (graph is not None and frozen is not graph):
+                return None
+            graph = frozen
+        return graph
+
+    def _start(self):
+        self.running = True
+        self.started = time.perf_counter()
+        return _active.set(self)
+
+    def _stop(self, token):
+        self.running = False
+        _active.reset(token)
+
+    def run(self):
+        token = self._start()
+        try:
+            self._run()
+        finally:
+            self._stop(token)
+
+    async def run_async(self):
+        token = self._start()
+        try:
+            await self._run_cancellable()
+        finally:
+            self._stop(token)
+
+    async def supersede(self, state):
+        """
+        Cancel the async propagation last started on state with supersede, waiting for it
+        to roll back, and register this one in its place
+        """
+        if self.token is None:
+            self.token = CancelToken()
+        previous = self.inflight.get(state)
+        self.inflight[state] = self.token
+        if previous is not None:
+            previous.cancel()
+            await previous.wait()
+
+    def superseded(self, state):
+        """Unregister this propagation from state, unless it has been superseded already"""
+        if self.token is not None and self.inflight.get(state) is self.token:
+            del self.inflight[state]
+
+    async def _run_cancellable(self):
+        """_run_async, in a task which the token can cancel and which is cancelled at the deadline"""
+        if self.token is None and self.deadline is None:
+            await self._run_async()
+            return
+
+        loop = asyncio.get_event_loop()
+        task = asyncio.ensure_future(self._run_async())
+        if self.token is not None:
+            if self.token.cancelled:
+                task.cancel()
+            self.token.task = task
+        try:
+            await asyncio.wait_for(task, None if self.deadline is None else self.deadline - loop.time())
+        except asyncio.CancelledError:
+            if task.cancelled() and self.token is not None and self.token.cancelled:
+                raise TransitionCancelled('Transition cancelled') from None
+            raise
+
+    def _run(self):
+        while self.pending:
+            if self.locking is None:
+                self._apply(self.plan())
+                continue
+            pending, steps = list(self.pending), self.steps
+            held = set()
+            while True:
+                planned, visited = self._replan(pending, steps, held)
+                if planned is not None:
+                    break
+                held = self.locking.acquire(visited)
+            try:
+                self._apply(planned)
+            finally:
+                self.locking.release(held)
+
+    def _replan(self, pending: list, steps: int, held: set):
+        """
+        Plan the pending changes with the States in held locked. If the plan visits a State
+        which isn't locked, the locks are released, pending and steps are restored and
+        (None, the States to lock) is returned to try again.
+        """
+        visited = set()
+        try:
+            planned = self.plan(visited)
+        except:
+            self.locking.release(held)
+            raise
+        if visited <= held:
+            return planned, visited
+        self.locking.release(held)
+        self.pending, self.steps = collections.deque(pending), steps
+        return None, visited | held
+
+    def _apply(self, planned):
+        if self.graph is not None:
+            self.graph.apply(planned, self.started)
+            return
+        for state, _, _, _, _ in planned.values():
+            state.check_for_async()
+        for band in _bands(planned.values()):
+            self._apply_band(band)
+
+    def _apply_band(self, band):
+        # (state, new_state, priority, locked outputs) for each transition
+        acquired = []
+        try:
+            for state, new_state, source, _, priority in band:
+                if state.check_change_state(new_state, source):
+                    acquired.append((state, new_state, priority, state._acquire(new_state)))
+
+            for state, new_state, priority, locked in acquired:
+                state._enact(new_state, locked)
+                if state.metrics is not None:
+                    state.metrics.enacted(priority, time.perf_counter() - self.started)
+        finally:
+            for _, _, _, locked in acquired:
+                for obj in locked:
+                    obj.release_lock()
+
+    async def _run_async(self):
+        while self.pending:
+            if self.locking is None:
+                await self._apply_async(self.plan())
+                continue
+            pending, steps = list(self.pending), self.steps
+            held = set()
+            while True:
+                planned, visited = self._replan(pending, steps, held)
+                if planned is not None:
+                    break
+                held = await self.locking.acquire_async(visited)
+            try:
+                await self._apply_async(planned)
+            finally:
+                self.locking.release(held)
+
+    async def _apply_async(self, planned):
+        for band in _bands(planned.values()):
+            await self._apply_band_async(band)
+
+    async def _apply_band_async(self, band):
+        # (state, new_state, priority, locked sync outputs, locked async outputs) for each transition
+        acquired = []
+        try:
+            for state, new_state, source, _, priority in band:
+                if state.check_change_state(new_state, source):
+                    acquired.append((state, new_state, priority) +
+                                    await state._acquire_async(new_state, self.concurrent, self.timeout))
+
+            for state, new_state, priority, locked, locked_async in acquired:
+                await state._enact_async(new_state, locked, locked_async, self.concurrent, self.timeout)
+                if state.metrics is not None:
+                    state.metrics.enacted(priority, time.perf_counter() - self.started)
+        finally:
+            for state, _, _, locked, locked_async in acquired:
+                await asyncio.shield(state._release_async(locked, locked_async, self.concurrent, self.timeout))
+
+
+class Transaction(Propagation):
+    """
+    A Propagation which buffers changes until the end of a with block - see transaction()
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.buffer = collections.OrderedDict()
+        self.buffering = False
+        self.context_token = None
+
+    def add(self, state, new_state: str, source=None):
+        if not self.buffering:
+            return super().add(state, new_state, source)
+        assert new_state in state.states
+        self.buffer[state] = (new_state, source)
+        return self
+
+    def _begin(self):
+        if Propagation.active() is not None:
+            # join the enclosing transaction or propagation
+            return
+        self.buffering = True
+        self.context_token = self._start()
+
+    def _commit(self):
+        self.buffering = False
+        for state, (new_state, source) in self.buffer.items():
+            super().add(state, new_state, source)
+        self.buffer.clear()
+
+    def __enter__(self):
+        self._begin()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.context_token is None:
+            return
+        try:
+            if exc_type is None:
+                self._commit()
+                self._run()
+                if self.journal is not None:
+                    self.journal.commit()
+        finally:
+            self._stop(self.context_token)
+
+    async def __aenter__(self):
+        self._begin()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if self.context_token is None:
+            return
+        try:
+            if exc_type is None:
+                self._commit()
+                await self._run_cancellable()
+                if self.journal is not None:
+                    await self.journal.commit_async()
+        finally:
+            self._stop(self.context_token)
+
+
+def transaction(**kwargs) -> Transaction:
+    """
+    Buffer the state changes made inside a with block and enact them together
+    in a single propagation when the block exits.
+
+    Only the last change to each State is enacted, so downstream States and
+    outputs only see the final values :-
+
+    >>> from aios import State, transaction
+    >>> class Output(object):
+    ...     def __init__(self):
+    ...         self.changes = []
+    ...     def acquire_lock(self, new_state):
+    ...         self.changes.append(new_state)
+    ...     def change(self): pass
+    ...     def release_lock(self): pass
+    ...     def require_async(self): return False
+    >>> A = State(['open', 'closed'], name='A', default='closed')
+    >>> B = State(['open', 'closed'], name='B', default='closed')
+    >>> output = Output()
+    >>> B.set_output(output)
+    >>> B.set_input(dict(open=A.open, closed=A.closed))
+    >>> with transaction():
+    ...     A.open = True
+    ...     A.closed = True
+    ...     A.open = True
+    ...     print(A)
+    A=[open, CLOSED]
+    >>> print(A, B, output.changes)
+    A=[OPEN, closed] B=[OPEN, closed] ['open']
+
+    Use async with in coroutines, so outputs can be awaited (the keyword arguments
+    are passed to Propagation, eg concurrent and timeout) :-
+
+    >>> import asyncio
+    >>> async def refresh():
+    ...     async with transaction(concurrent=True):
+    ...         A.closed = True
+    ...         await A.change_state_async('open')
+    >>> asyncio.get_event_loop().run_until_complete(refresh())
+    >>> print(A, B, output.changes)
+    A=[OPEN, closed] B=[OPEN, closed] ['open']
+
+    If the block raises an exception, the buffered changes are discarded. A transaction
+    started while another transaction or propagation is running joins it.
+    """
+    return Transaction(**kwargs)
+
+
+def enact(changes, source=None, loop: asyncio.AbstractEventLoop=None):
+    """
+    Change each (State, new_state) in changes - States which don't require async are
+    changed together in one transaction, the others in a task on the event loop.
+    """
+    with transaction():
+        for dest, dest_state in changes:
+            if not dest.async_required:
+                dest.change_state(dest_state, source)
+
+    for dest, dest_state in changes:
+        if dest.async_required:
+            asyncio.ensure_future(dest.change_state_async(dest_state, source), loop=loop)
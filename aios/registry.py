@@ -0,0 +1,126 @@
+import logging
+from typing import Dict, Iterator
+
+from aios.object import Object
+from aios.state import State, StateSchema
+
+logger = logging.getLogger('aios.registry')
+
+
+class Registry(object):
+    """
+    Registry keeps an inverted index from current state to the registered States in
+    that state, so questions like "which doors are open" don't need to walk the hierarchy.
+
+    >>> site = Object(name='site', children={
+    ...     'b{}'.format(b): Object(children={
+    ...         'd{}'.format(d): Object(children={'door': State(['open', 'closed'], default='closed')})
+    ...         for d in range(3)})
+    ...     for b in range(2)})
+    >>> registry = Registry(site)
+    >>> site.b0.d1.door.open = True
+    >>> site.b1.d2.door.open = True
+    >>> registry.count('open'), registry.count('closed')
+    (2, 4)
+    >>> sorted(_.__parent__._aios_qualified_name() for _ in registry.states('open'))
+    ['site.b0.d1', 'site.b1.d2']
+
+    Queries can be limited to the States below an object in the hierarchy
+
+    >>> [_.__parent__._aios_qualified_name() for _ in registry.states('open', within=site.b1)]
+    ['site.b1.d2']
+    >>> registry.counts(within=site.b0)
+    {'open': 1, 'closed': 2}
+    >>> registry.close()
+
+    Each State is indexed under the registry as a whole and under each of its parent objects,
+    so a transition updates one set per level of the hierarchy, and queries take time
+    proportional to the number of States returned. Call close() to stop updating the registry.
+    """
+
+    def __init__(self, root: Object=None):
+        # scope (None for the whole registry, or an Object) -> schema -> [set of States per state index]
+        self.index = dict()
+        # state name -> schemas with that state
+        self.schemas = dict()
+        # State -> buckets to update, one per scope
+        self.members = dict()
+        State.observers.append(self.update)
+
+        if root is not None:
+            self.add_tree(root)
+
+    def close(self):
+        State.observers.remove(self.update)
+
+    def __len__(self):
+        return len(self.members)
+
+    def __contains__(self, state: State):
+        return state in self.members
+
+    def add(self, state: State):
+        if state in self.members:
+            return
+
+        schema = state.schema
+        for name in schema:
+            self.schemas.setdefault(name, set()).add(schema)
+
+        scopes = [None]
+        parent = getattr(state, '__parent__', None)
+        while parent is not None:
+            scopes.append(parent)
+            parent = parent.__dict__.get('__parent__')
+
+        buckets = self.members[state] = [self.buckets(scope, schema) for scope in scopes]
+        index = state._index
+        if index is not None:
+            for _ in buckets:
+                _[index].add(state)
+
+    def add_tree(self, root: Object):
+        """Add every State below root"""
+        for path, obj in root._aios_walk():
+            if isinstance(obj, State):
+                self.add(obj)
+
+    def buckets(self, scope, schema: StateSchema):
+        try:
+            return self.index[scope][schema]
+        except KeyError:
+            buckets = self.index.setdefault(scope, dict())[schema] = [set() for _ in schema]
+            return buckets
+
+    def update(self, state: State, old: int, new: int):
+        buckets = self.members.get(state)
+        if buckets is None:
+            return
+        for _ in buckets:
+            if old is not None:
+                _[old].discard(state)
+            _[new].add(state)
+
+    def states(self, name: str, within: Object=None) -> Iterator[State]:
+        """Iterate over the States in state name"""
+        schemas = self.index.get(within)
+        if not schemas:
+            return
+        for schema in self.schemas.get(name, ()):
+            buckets = schemas.get(schema)
+            if buckets is not None:
+                yield from buckets[schema.index[name]]
+
+    def count(self, name: str, within: Object=None) -> int:
+        schemas = self.index.get(within)
+        if not schemas:
+            return 0
+        return sum(len(schemas[_][_.index[name]]) for _ in self.schemas.get(name, ()) if _ in schemas)
+
+    def counts(self, within: Object=None) -> Dict[str, int]:
+        """Return the number of States in each state"""
+        counts = dict()
+        for schema, buckets in self.index.get(within, {}).items():
+            for name, bucket in zip(schema, buckets):
+                counts[name] = counts.get(name, 0) + len(bucket)
+        return counts
@@ -0,0 +1,279 @@
+import asyncio
+import bisect
+import datetime
+import heapq
+import logging
+import time
+from typing import Tuple
+
+from aios import state, propagation
+
+logger = logging.getLogger('aios.schedule')
+
+
+class Cron(object):
+    """
+    A cron expression - minute hour day-of-month month day-of-week, where each
+    field is *, a number, a range (a-b), a step (*/n, a-b/n) or a list of these.
+    Day of week is 0-6 starting on Sunday (7 is also Sunday).
+
+    >>> cron = Cron.get('*/15 9-17 * * 1-5')
+    >>> print(cron.next_after(datetime.datetime(2024, 1, 5, 17, 50)))
+    2024-01-08 09:00:00
+    >>> print(cron.next_after(datetime.datetime(2024, 1, 8, 9, 0)))
+    2024-01-08 09:15:00
+
+    As with cron, if both day of month and day of week are restricted, a day matching
+    either one matches.
+
+    >>> print(Cron.get('0 0 13 * 5').next_after(datetime.datetime(2024, 1, 1)))
+    2024-01-05 00:00:00
+
+    Cron.get caches parsed expressions, so schedules using the same expression share one Cron
+    """
+
+    cache = dict()
+
+    ranges = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    def __init__(self, expression: str):
+        fields = expression.split()
+        assert len(fields) == 5, 'Cron expressions have 5 fields: minute hour day month weekday'
+
+        self.expression = expression
+        minutes, hours, self.days, self.months, weekdays = (
+            self.parse_field(field, *limits) for field, limits in zip(fields, self.ranges))
+        self.minutes = sorted(minutes)
+        self.hours = sorted(hours)
+        self.weekdays = frozenset(_ % 7 for _ in weekdays)
+        self.any_day = fields[2] == '*'
+        self.any_weekday = fields[4] == '*'
+
+    @classmethod
+    def get(cls, expression: str) -> 'Cron':
+        try:
+            return cls.cache[expression]
+        except KeyError:
+            cron = cls.cache[expression] = cls(expression)
+            return cron
+
+    @staticmethod
+    def parse_field(field: str, lowest: int, highest: int) -> frozenset:
+        values = set()
+        for part in field.split(','):
+            step = 1
+            if '/' in part:
+                part, step = part.split('/')
+                step = int(step)
+            if part == '*':
+                start, end = lowest, highest
+            elif '-' in part:
+                start, end = map(int, part.split('-'))
+            else:
+                start = int(part)
+                end = highest if step != 1 else start
+            assert lowest <= start <= end <= highest and step > 0, 'Invalid cron field "{}"'.format(field)
+            values.update(range(start, end + 1, step))
+        return frozenset(values)
+
+    def day_matches(self, dt: datetime.datetime) -> bool:
+        weekday = (dt.weekday() + 1) % 7 in self.weekdays
+        if self.any_day:
+            return weekday
+        day = dt.day in self.days
+        if self.any_weekday:
+            return day
+        return day or weekday
+
+    def next_after(self, dt: datetime.datetime) -> datetime.datetime:
+        """Return the first time matching the expression after dt"""
+        dt = dt.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+        limit = dt.year + 5
+
+        while dt.year <= limit:
+            if dt.month not in self.months:
+                dt = (dt.replace(day=1, hour=0, minute=0) + datetime.timedelta(days=32)).replace(day=1)
+                continue
+
+            if not self.day_matches(dt):
+                dt = dt.replace(hour=0, minute=0) + datetime.timedelta(days=1)
+                continue
+
+            idx = bisect.bisect_left(self.hours, dt.hour)
+            if idx == len(self.hours):
+                dt = dt.replace(hour=0, minute=0) + datetime.timedelta(days=1)
+                continue
+            if self.hours[idx] != dt.hour:
+                dt = dt.replace(hour=self.hours[idx], minute=0)
+
+            idx = bisect.bisect_left(self.minutes, dt.minute)
+            if idx == len(self.minutes):
+                dt = dt.replace(minute=0) + datetime.timedelta(hours=1)
+                continue
+            return dt.replace(minute=self.minutes[idx])
+
+        raise ValueError('Cron expression "{}" never matches'.format(self.expression))
+
+
+class Job(object):
+    """A scheduled change of a State - returned by Scheduler.every and Scheduler.cron"""
+
+    __slots__ = ('scheduler', 'when', 'interval', 'cron', 'dest', 'dest_state', 'missed', 'grace', 'cancelled')
+
+    def __init__(self, scheduler, when, interval, cron, output, missed, grace):
+        assert missed in Scheduler.MISSED
+        self.scheduler = scheduler
+        self.when = when
+        self.interval = interval
+        self.cron = cron
+        self.dest, self.dest_state = output
+        self.missed = missed
+        self.grace = grace
+        self.cancelled = False
+
+    def next_after(self, now: float) -> float:
+        if self.cron is not None:
+            return self.cron.next_after(datetime.datetime.fromtimestamp(now)).timestamp()
+        # stay in phase with the original schedule
+        return self.when + self.interval * ((now - self.when) // self.interval + 1)
+
+    def cancel(self):
+        self.scheduler.cancel(self)
+
+
+class Scheduler(object):
+    """
+    Scheduler changes States at intervals or on a cron schedule.
+
+    >>> from aios import State
+    >>> lights = State(['on', 'off'], name='lights', default='off')
+    >>> scheduler = Scheduler()
+    >>> job = scheduler.every(0.05, lights.on)
+    >>> loop = asyncio.get_event_loop()
+    >>> loop.run_until_complete(asyncio.sleep(0.08))
+    >>> print(lights)
+    lights=[ON, off]
+    >>> job.cancel()
+    >>> len(scheduler)
+    0
+
+    All schedules are kept in one heap ordered by their next fire time, with a single
+    timer on the event loop for the earliest of them. The next fire time of a schedule
+    is only worked out once it has fired.
+
+    If the event loop stalls and a schedule fires more than grace seconds late, missed
+    decides what happens - 'fire' changes the State anyway (once, however many times
+    were missed) and 'skip' waits for the next scheduled time :-
+
+    >>> lights.off = True
+    >>> job = scheduler.every(60, lights.on, start=time.time() - 120, missed='skip')
+    >>> loop.run_until_complete(asyncio.sleep(0.01))
+    >>> print(lights)
+    lights=[on, OFF]
+    >>> job.when - time.time() > 0
+    True
+    """
+
+    MISSED = ('fire', 'skip')
+
+    def __init__(self, loop: asyncio.AbstractEventLoop=None):
+        self.loop = loop
+        # heap of (when, seq, job)
+        self.jobs = []
+        self.active = 0
+        self.cancelled = 0
+        self.seq = 0
+        self.handle = None
+        self.handle_when = None
+
+    def __len__(self):
+        return self.active
+
+    def every(self,
+              interval: float,
+              output: Tuple['state.State', str],
+              start: float=None,
+              missed: str='fire',
+              grace: float=1.0) -> Job:
+        """Change output every interval seconds, starting at the time.time() start (default now + interval)"""
+
+        assert interval > 0
+        assert state.State.check_state_tuple(output)
+        if start is None:
+            start = time.time() + interval
+        return self.add(Job(self, start, interval, None, output, missed, grace))
+
+    def cron(self,
+             expression: str,
+             output: Tuple['state.State', str],
+             missed: str='fire',
+             grace: float=60.0) -> Job:
+        """Change output at the times given by a cron expression (in local time)"""
+
+        assert state.State.check_state_tuple(output)
+        cron = Cron.get(expression)
+        when = cron.next_after(datetime.datetime.now()).timestamp()
+        return self.add(Job(self, when, None, cron, output, missed, grace))
+
+    def add(self, job: Job) -> Job:
+        self.active += 1
+        self.push(job)
+        return job
+
+    def push(self, job: Job):
+        heapq.heappush(self.jobs, (job.when, self.seq, job))
+        self.seq += 1
+        if self.handle is None or job.when < self.handle_when:
+            self.rearm()
+
+    def cancel(self, job: Job):
+        if job.cancelled:
+            return
+        job.cancelled = True
+        self.active -= 1
+        self.cancelled += 1
+
+        if self.cancelled > 1024 and self.cancelled > len(self.jobs) // 2:
+            self.jobs = [_ for _ in self.jobs if not _[2].cancelled]
+            heapq.heapify(self.jobs)
+            self.cancelled = 0
+
+    def rearm(self):
+        while self.jobs and self.jobs[0][2].cancelled:
+            heapq.heappop(self.jobs)
+            self.cancelled -= 1
+
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+
+        if self.jobs:
+            if self.loop is None:
+                self.loop = asyncio.get_event_loop()
+            self.handle_when = self.jobs[0][0]
+            self.handle = self.loop.call_later(max(0, self.handle_when - time.time()), self.fire)
+
+    def fire(self):
+        self.handle = None
+        now = time.time()
+
+        due = []
+        while self.jobs and self.jobs[0][0] <= now:
+            when, _, job = heapq.heappop(self.jobs)
+            if job.cancelled:
+                self.cancelled -= 1
+                continue
+
+            if now - when <= job.grace or job.missed == 'fire':
+                due.append((job.dest, job.dest_state))
+            else:
+                logger.info('Skipped change of {} to {} due at {}'.format(job.dest.__name__, job.dest_state, when))
+
+            job.when = job.next_after(now)
+            heapq.heappush(self.jobs, (job.when, self.seq, job))
+            self.seq += 1
+
+        self.rearm()
+
+        # changes which fall due together are enacted in a single propagation
+        propagation.enact(due, self, self.loop)
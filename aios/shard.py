@@ -0,0 +1,416 @@
+"""
+Sharding an Object hierarchy across worker processes.
+
+Every process builds the same hierarchy (with a build function), and each worker
+owns the States below some of the top level children of the root. The current
+state of each owned State is kept in a shared memory table (int16 per State,
+-1 if undefined) for that shard, which any process can read without copying or
+messaging the worker. Each shard also logs the slots it changes (in a ring buffer
+of LOG entries, after a count of the changes), so each worker can update its copies
+of the States owned by other shards before applying a batch, in time proportional
+to the number of changes rather than the number of States.
+
+set_input links from a State in one shard to a State in another are replaced in
+the worker by an output which queues the change, and the queued changes for each
+shard are sent as one message once the worker has applied its current batch.
+Links which cross shards don't take part in cycle detection.
+
+A ConditionalInputOutput whose inputs and outputs aren't all in one shard is
+rejected when the Layout is created. Other outputs must only change States in
+the shard of the State they're attached to.
+"""
+
+import asyncio
+import logging
+import multiprocessing
+import os
+import queue
+from multiprocessing import shared_memory
+from typing import Callable, Dict, Iterable, List, Tuple
+
+from aios.logic import ConditionalInputOutput
+from aios.object import Object
+from aios.propagation import transaction
+from aios.snapshot import _states
+from aios.state import State
+
+logger = logging.getLogger('aios.shard')
+
+# slots in each shard's log of changes - a worker which falls further behind rereads the whole table
+LOG = 16384
+
+
+def _size(count: int) -> int:
+    return 8 + 4 * LOG + max(2 * count, 2)
+
+
+def _views(memory: shared_memory.SharedMemory, count: int):
+    """The (count of changes, log of changed slots, table) views of a shard's shared memory"""
+    buf = memory.buf
+    return buf[:8].cast('q'), buf[8:8 + 4 * LOG].cast('i'), buf[8 + 4 * LOG:8 + 4 * LOG + 2 * count].cast('h')
+
+
+def _round_robin(root: Object, shards: int) -> Dict[str, int]:
+    return {key: i % shards for i, key in enumerate(root._aios_children)}
+
+
+class Layout(object):
+    """
+    The shard and slot of every State below root, which is the same in every process
+
+    >>> site = Object(name='site', children={
+    ...     'b0': Object(children={'door': State(['open', 'closed'], default='closed')}),
+    ...     'b1': Object(children={'alarm': State(['ringing', 'silent'], default='silent')})})
+    >>> gate = ConditionalInputOutput(all, [site.b0.door.open], [site.b1.alarm.ringing])
+    >>> Layout(site, 2)
+    Traceback (most recent call last):
+    ...
+    Exception: <aios.logic.ConditionalInputOutput object at 0x...> links States in more than one shard: door.open, alarm.ringing
+    """
+
+    def __init__(self, root: Object, shards: int, partition: Callable=None):
+        self.paths, self.states = _states(root)
+        top = partition(root, shards) if partition is not None else _round_robin(root, shards)
+
+        # global id (position in paths) -> (shard, slot in the shard's table)
+        self.slots = []
+        self.counts = [0] * shards
+        for path in self.paths:
+            key = path.partition('.')[0]
+            shard = top.get(key, 0) if '.' in path else 0
+            self.slots.append((shard, self.counts[shard]))
+            self.counts[shard] += 1
+        self.ids = {path: gid for gid, path in enumerate(self.paths)}
+        self.check()
+
+    def check(self):
+        """Raise an exception if a ConditionalInputOutput gate has inputs or outputs in more than one shard"""
+        shards = {state: self.slots[gid][0] for gid, state in enumerate(self.states)}
+        checked = set()
+        for state in self.states:
+            for obj in state._outputs or ():
+                gate = getattr(obj, 'parent', None)
+                if not isinstance(gate, ConditionalInputOutput) or gate in checked:
+                    continue
+                checked.add(gate)
+                if len({shards.get(_) for _, _state in gate.inputs + gate.outputs}) > 1:
+                    raise Exception('{} links States in more than one shard: {}'.format(gate, ', '.join(
+                        '{}.{}'.format(_.__name__, _state) for _, _state in gate.inputs + gate.outputs)))
+
+
+class RemoteLinks(object):
+    """Output on a State with set_input links to States in other shards"""
+
+    def __init__(self, outbox: Dict[int, List], links: Dict[str, List[Tuple[int, int, int]]]):
+        self.outbox = outbox
+        # state -> [(shard, global id, index of the new state)]
+        self.links = links
+        self.new_state = None
+
+    def acquire_lock(self, new_state):
+        self.new_state = new_state
+
+    def change(self):
+        for shard, gid, index in self.links.get(self.new_state, ()):
+            self.outbox.setdefault(shard, []).append((gid, index))
+
+    def release_lock(self):
+        self.new_state = None
+
+    def require_async(self):
+        return False
+
+
+class Cluster(object):
+    """
+    Cluster runs an Object hierarchy across shards worker processes.
+
+    build is called in each process to create the hierarchy (so it must be picklable
+    unless the 'fork' context is used). By default the top level children of the root
+    are assigned to shards round robin - partition(root, shards) can return a dict of
+    top level child name -> shard instead. States directly on the root belong to shard 0.
+
+    >>> def build():
+    ...     site = Object(name='site', children={
+    ...         'b{}'.format(b): Object(children={
+    ...             'power': State(['on', 'off'], default='off'),
+    ...             'light': State(['on', 'off'], default='off')})
+    ...         for b in range(4)})
+    ...     site.b0.light.on = site.b0.power.on
+    ...     site.b1.light.on = site.b0.power.on
+    ...     site.b2.light.on = site.b1.light.on
+    ...     return site
+    >>> cluster = Cluster(build, shards=2, context='fork').start()
+    >>> [cluster.shard(_) for _ in ('b0.light', 'b1.light', 'b2.light')]
+    [0, 1, 0]
+
+    change() sends changes to the shards which own the States, and settle() waits
+    until every shard is idle, raising the first error from any worker. read() reads
+    the current state straight from the shared memory table.
+
+    >>> cluster.change([('b0.power', 'on')])
+    >>> cluster.settle()
+    >>> [cluster.read(_) for _ in ('b0.light', 'b1.light', 'b2.light', 'b3.light')]
+    ['on', 'on', 'on', 'off']
+    >>> cluster.table(1).tolist()
+    [1, 1, 1, 0]
+    >>> cluster.stop()
+    """
+
+    def __init__(self, build: Callable[[], Object], shards: int=None, partition: Callable=None, context: str=None):
+        self.build = build
+        self.shards = shards or os.cpu_count()
+        self.partition = partition
+        self.context = multiprocessing.get_context(context)
+        self.root = build()
+        self.layout = Layout(self.root, self.shards, partition)
+        self.memory = []
+        # shard -> its (count of changes, log, table) views
+        self.regions = []
+        self.views = []
+        self.inboxes = []
+        self.results = None
+        self.workers = []
+        # change messages sent to the shards
+        self.sent = 0
+
+    def start(self) -> 'Cluster':
+        self.results = self.context.Queue()
+        for shard in range(self.shards):
+            memory = shared_memory.SharedMemory(create=True, size=_size(self.layout.counts[shard]))
+            self.memory.append(memory)
+            self.regions.append(_views(memory, self.layout.counts[shard]))
+            self.views.append(self.regions[-1][2])
+            self.inboxes.append(self.context.Queue())
+
+        for shard in range(self.shards):
+            worker = self.context.Process(
+                target=_worker, name='aios-shard-{}'.format(shard), daemon=True,
+                args=(self.build, self.shards, shard, self.partition,
+                      [_.name for _ in self.memory], self.inboxes, self.results))
+            worker.start()
+            self.workers.append(worker)
+
+        for _ in range(self.shards):
+            self.results.get()
+        return self
+
+    def shard(self, path: str) -> int:
+        return self.layout.slots[self.layout.ids[path]][0]
+
+    def table(self, shard: int) -> memoryview:
+        """The shared memory table of a shard - the state index of each State it owns, in order"""
+        return self.views[shard]
+
+    def read(self, path: str) -> str:
+        gid = self.layout.ids[path]
+        shard, slot = self.layout.slots[gid]
+        index = self.views[shard][slot]
+        return None if index < 0 else self.layout.states[gid].schema.states[index]
+
+    def change(self, changes: Iterable[Tuple[str, str]]):
+        """Send (path, new_state) changes to their shards, as one message per shard"""
+        batches = dict()
+        for path, new_state in changes:
+            gid = self.layout.ids[path]
+            index = self.layout.states[gid].schema.index[new_state]
+            batches.setdefault(self.layout.slots[gid][0], []).append((gid, index))
+        for shard, batch in batches.items():
+            self.inboxes[shard].put(('change', batch))
+            self.sent += 1
+
+    def settle(self):
+        """
+        Wait until no changes are queued or in flight between the shards - when two rounds
+        of asking every shard for its count of change messages sent and received agree
+        that every message sent has been received.
+        """
+        previous = None
+        while True:
+            for _ in self.inboxes:
+                _.put(('barrier', None))
+            sent = self.sent
+            received = 0
+            errors = []
+            for _ in range(self.shards):
+                shard_sent, shard_received, error = self.results.get()
+                sent += shard_sent
+                received += shard_received
+                if error is not None:
+                    errors.append(error)
+            if errors:
+                raise Exception(errors[0])
+            if sent == received and previous == (sent, received):
+                return
+            previous = (sent, received)
+
+    def stop(self):
+        for _ in self.inboxes:
+            _.put(('stop', None))
+        for _ in self.workers:
+            _.join()
+        for region in self.regions:
+            for view in region:
+                view.release()
+        for memory in self.memory:
+            memory.close()
+            memory.unlink()
+        self.workers, self.regions, self.views, self.memory, self.inboxes = [], [], [], [], []
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+
+class _Shard(object):
+    """The worker side of a shard - see Cluster"""
+
+    def __init__(self, build, shards, shard, partition, names, inboxes, results):
+        self.root = build()
+        self.layout = layout = Layout(self.root, shards, partition)
+        self.shard = shard
+        self.inboxes = inboxes
+        self.results = results
+        self.memory = [shared_memory.SharedMemory(name=_) for _ in names]
+        self.regions = [_views(memory, count) for memory, count in zip(self.memory, layout.counts)]
+        self.sequence, self.log, self.table = self.regions[shard]
+        table = self.table
+        # changes logged by this shard
+        self.logged = 0
+        self.loop = asyncio.new_event_loop()
+        # shard -> [(global id, state index)] to send once the current batch is applied
+        self.outbox = dict()
+        # change messages sent to and received from the other shards and the Cluster
+        self.sent = 0
+        self.received = 0
+        self.error = None
+
+        gids = {state: gid for gid, state in enumerate(layout.states)}
+        # owned State -> slot
+        self.slots = dict()
+        # other shard -> the States it owns, in slot order, and its count of changes when last read
+        self.others = {_: [] for _ in range(shards) if _ != shard}
+        self.seen = dict()
+        for gid, state in enumerate(layout.states):
+            owner, slot = layout.slots[gid]
+            if owner != shard:
+                self.others[owner].append(state)
+                continue
+            self.slots[state] = slot
+            table[slot] = -1 if state._index is None else state._index
+
+            remote = dict()
+            for new_state, links in (state._callbacks or {}).items():
+                local = []
+                for dest, dest_state in links:
+                    dest_shard = layout.slots[gids[dest]][0]
+                    if dest_shard == shard:
+                        local.append((dest, dest_state))
+                    else:
+                        remote.setdefault(new_state, []).append((dest_shard, gids[dest], dest.schema.index[dest_state]))
+                links[:] = local
+            if remote:
+                state.set_output(RemoteLinks(self.outbox, remote))
+
+    def update(self, state: State, old: int, new: int):
+        slot = self.slots.get(state)
+        if slot is not None:
+            self.table[slot] = new
+            # the slot is logged before the count is updated, so readers see it once it's counted
+            self.log[self.logged % LOG] = slot
+            self.logged += 1
+            self.sequence[0] = self.logged
+
+    def refresh(self):
+        """Update the States owned by other shards which they have changed since the last refresh"""
+        for shard, states in self.others.items():
+            sequence, log, table = self.regions[shard]
+            logged = sequence[0]
+            last = self.seen.get(shard, 0)
+            if logged == last:
+                continue
+            slots = [log[_ % LOG] for _ in range(last, logged)] if logged - last <= LOG else None
+            if slots is None or sequence[0] - last > LOG:
+                # too far behind (or overwritten while reading), so reread the whole table
+                slots = range(len(states))
+            for slot in slots:
+                index = table[slot]
+                states[slot]._index = None if index < 0 else index
+            self.seen[shard] = logged
+
+    def apply(self, changes: List[Tuple[int, int]]):
+        """Apply (global id, state index) changes, then send the queued changes for other shards"""
+        if changes:
+            self.refresh()
+            try:
+                _apply(self.layout, changes, self.loop)
+            except Exception as e:
+                logger.exception('Shard {} failed to apply changes'.format(self.shard))
+                if self.error is None:
+                    self.error = '{}: {}'.format(type(e).__name__, e)
+
+        for shard, batch in self.outbox.items():
+            self.inboxes[shard].put(('change', batch))
+            self.sent += 1
+        self.outbox.clear()
+
+    def run(self):
+        inbox = self.inboxes[self.shard]
+        State.observers.append(self.update)
+        self.results.put(None)
+
+        try:
+            while True:
+                messages = [inbox.get()]
+                while True:
+                    try:
+                        messages.append(inbox.get_nowait())
+                    except queue.Empty:
+                        break
+
+                changes = []
+                for kind, body in messages:
+                    if kind == 'change':
+                        changes.extend(body)
+                        self.received += 1
+                        continue
+                    self.apply(changes)
+                    changes = []
+                    if kind == 'stop':
+                        return
+                    self.results.put((self.sent, self.received, self.error))
+                    self.error = None
+                self.apply(changes)
+        finally:
+            State.observers.remove(self.update)
+            self.loop.close()
+            for region in self.regions:
+                for view in region:
+                    view.release()
+            for memory in self.memory:
+                memory.close()
+
+
+def _worker(*args):
+    _Shard(*args).run()
+
+
+def _apply(layout: Layout, changes: List[Tuple[int, int]], loop: asyncio.AbstractEventLoop):
+    """Apply (global id, state index) changes - the last change to each State wins"""
+    latest = dict()
+    for gid, index in changes:
+        latest[gid] = index
+
+    pending = []
+    with transaction():
+        for gid, index in latest.items():
+            state = layout.states[gid]
+            new_state = state.schema.states[index]
+            if state.async_required:
+                pending.append(state.change_state_async(new_state))
+            else:
+                state.change_state(new_state)
+    if pending:
+        loop.run_until_complete(asyncio.gather(*pending))
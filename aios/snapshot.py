@@ -0,0 +1,213 @@
+"""
+Snapshots of the current state of every State below an Object.
+
+The file is little-endian :-
+
+* header - magic b'AIOS', format version (uint16), number of States (uint32),
+  number of schemas (uint32), length of the schema table and of the path table
+  in bytes (uint32 each)
+* schema table - utf-8, one schema per line with its states separated by spaces
+* path table - utf-8, the dotted path of each State below the Object, one per line
+* the schema of each State, as an index into the schema table (uint16 each)
+* the current state of each State, as an index into its schema, -1 if undefined (int16 each)
+"""
+
+import array
+import logging
+import mmap
+import os
+import struct
+import sys
+
+from aios.object import Object
+from aios.state import State
+
+logger = logging.getLogger('aios.snapshot')
+
+MAGIC = b'AIOS'
+VERSION = 1
+HEADER = struct.Struct('<4sHIIII')
+
+
+def _little_endian(values: array.array) -> bytes:
+    if sys.byteorder != 'little':
+        values = array.array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def _states(root: Object):
+    """Return the paths of every State below root, and the States, in _aios_walk order"""
+    paths = []
+    states = []
+    pending = [('', root)]
+    while pending:
+        prefix, node = pending.pop()
+        if node._aios_lazy:
+            node._aios_expand()
+        for name, obj in node._aios_children.items():
+            if isinstance(obj, State):
+                paths.append(prefix + name)
+                states.append(obj)
+            elif isinstance(obj, Object):
+                pending.append((prefix + name + '.', obj))
+    return paths, states
+
+
+def snapshot(root, filename: str) -> int:
+    """Write the current state of every State below root to filename, returning the number of States"""
+
+    schemas = dict()
+    paths, states = _states(root)
+    schema_ids = array.array('H')
+    indices = array.array('h')
+
+    for obj in states:
+        schema = obj._schema
+        schema_id = schemas.get(schema)
+        if schema_id is None:
+            schema_id = schemas[schema] = len(schemas)
+        schema_ids.append(schema_id)
+        index = obj._index
+        indices.append(-1 if index is None else index)
+
+    schema_table = '\n'.join(' '.join(_) for _ in schemas).encode()
+    path_table = '\n'.join(paths).encode()
+
+    tmp = '{}.tmp'.format(filename)
+    with open(tmp, 'wb') as fh:
+        fh.write(HEADER.pack(MAGIC, VERSION, len(paths), len(schemas), len(schema_table), len(path_table)))
+        fh.write(schema_table)
+        fh.write(path_table)
+        fh.write(_little_endian(schema_ids))
+        fh.write(_little_endian(indices))
+    os.replace(tmp, filename)
+
+    return len(paths)
+
+
+def restore(root, filename: str, outputs: bool=False) -> int:
+    """
+    Restore the States below root from a snapshot, returning the number of States changed.
+
+    With outputs=False the current state of each State is set directly, without calling
+    its outputs (State.observers are still notified, and ConditionalInputOutput gates
+    are updated to match). With outputs=True each State is
+    changed through its outputs, but the change isn't propagated to linked States, as
+    they are restored from the snapshot too.
+
+    States in the snapshot which no longer exist, or whose state no longer exists,
+    are skipped.
+
+    >>> import tempfile
+    >>> from aios.logic import ConditionalInputOutput
+    >>> def build():
+    ...     site = Object(name='site', children={
+    ...         'a': State(['on', 'off'], default='off'), 'b': State(['on', 'off'], default='off'),
+    ...         'alarm': State(['ringing', 'silent'], default='silent')})
+    ...     gate = ConditionalInputOutput(all, [site.a.on, site.b.on], [site.alarm.ringing])
+    ...     return site, gate
+    >>> site, gate = build()
+    >>> site.a.on = True
+    >>> site.b.on = True
+    >>> site.alarm.silent = True
+    >>> filename = os.path.join(tempfile.mkdtemp(), 'site.snapshot')
+    >>> snapshot(site, filename)
+    3
+    >>> site, gate = build()
+    >>> restore(site, filename)
+    2
+    >>> gate.satisfied, gate.result
+    (2, True)
+    >>> site.b.off = True
+    >>> site.b.on = True
+    >>> print(site.alarm)
+    alarm=[RINGING, silent]
+    >>> os.remove(filename)
+    """
+
+    with open(filename, 'rb') as fh, mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        magic, version, count, schema_count, schema_bytes, path_bytes = HEADER.unpack_from(mm)
+        if magic != MAGIC or version != VERSION:
+            raise Exception('{} is not an aios snapshot (version {})'.format(filename, VERSION))
+
+        offset = HEADER.size
+        schema_table = mm[offset:offset + schema_bytes].decode()
+        offset += schema_bytes
+        paths = mm[offset:offset + path_bytes].decode().split('\n') if count else []
+        offset += path_bytes
+
+        schema_ids = array.array('H')
+        schema_ids.frombytes(mm[offset:offset + 2 * count])
+        offset += 2 * count
+        indices = array.array('h')
+        indices.frombytes(mm[offset:offset + 2 * count])
+        if sys.byteorder != 'little':
+            schema_ids.byteswap()
+            indices.byteswap()
+
+    return _restore(root, paths, schema_table, schema_ids, indices, outputs)
+
+
+def _sync_gates(restored):
+    """
+    Update the ConditionalInputOutput gates with inputs among the (State, new_state) restored
+    without calling their outputs, so the gates' counts match the restored states
+    """
+    from aios.logic import ConditionalInputOutput
+
+    gates = dict()
+    for state, new_state in restored:
+        for obj in state._outputs or ():
+            gate = getattr(obj, 'parent', None)
+            if isinstance(gate, ConditionalInputOutput):
+                gate.update(obj.idx, new_state)
+                gates[gate] = None
+    for gate in gates:
+        gate.resync()
+
+
+def _restore(root, paths, schema_table, schema_ids, indices, outputs):
+    schemas = [tuple(_.split(' ')) for _ in schema_table.split('\n')] if schema_table else []
+    current, states = _states(root)
+    if current != paths:
+        # the hierarchy has changed since the snapshot, so match States by path
+        by_path = dict(zip(current, states))
+        states = [by_path.get(_) for _ in paths]
+    observers = State.observers
+
+    changed = 0
+    # (State, new_state) set directly, for _sync_gates
+    restored = []
+    for path, state, schema_id, index in zip(paths, states, schema_ids, indices):
+        if state is None:
+            continue
+
+        if index < 0:
+            index = None
+        elif state.schema.states != schemas[schema_id]:
+            name = schemas[schema_id][index]
+            index = state.schema.index.get(name)
+            if index is None:
+                logger.warning('Skipped {} - state {} no longer exists'.format(path, name))
+                continue
+
+        old = state._index
+        if old == index:
+            continue
+        changed += 1
+
+        if outputs and index is not None:
+            state.check_for_async()
+            state._apply(state.schema.states[index], root)
+            continue
+
+        state._index = index
+        if state._outputs:
+            restored.append((state, None if index is None else state.schema.states[index]))
+        if index is not None:
+            for observer in observers:
+                observer(state, old, index)
+
+    _sync_gates(restored)
+    return changed
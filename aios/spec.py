@@ -0,0 +1,172 @@
+"""
+Building Object hierarchies from a declarative spec - a dict, or JSON.
+
+A spec is a node with a name. Each node is either a State :-
+
+    {"state": "door", "default": "closed"}
+
+where state is the name of one of the spec's schemas (or a list of states), or
+an Object, with children and links :-
+
+    {"children": {"door": {...}, "light": {...}},
+     "links": [["light", "on", "door", "open"]]}
+
+Each link is [dest, dest state, source, source state] with an optional priority,
+where dest and source are dotted paths below the node - see State.set_input.
+
+"type" names an entry in the spec's types to use for the node (its children and
+links are merged with the node's own), and a child name with {} and a "repeat"
+count adds that many children, numbered from 0.
+"""
+
+import json
+import logging
+from typing import Callable, Dict
+
+from aios.object import Object
+from aios.state import State, StateSchema
+
+logger = logging.getLogger('aios.spec')
+
+
+class Loader(object):
+    """
+    Loader builds the hierarchy for a spec - see build()
+
+    Each Object child is created lazily, the first time it's used, so the time taken
+    depends on how much of the hierarchy is actually used. States are created together
+    with their parent Object, sharing one StateSchema per schema in the spec, and the
+    links of each Object are wired together once it has been created.
+    """
+
+    def __init__(self, spec: Dict, classes: Dict[str, type]=None, lazy: bool=True):
+        self.types = spec.get('types', {})
+        self.classes = classes or {}
+        self.lazy = lazy
+        self.schemas = {name: StateSchema.get(states) for name, states in spec.get('schemas', {}).items()}
+        self.spec = spec
+        # id of a node in the spec -> the node merged with its type
+        self.resolved = dict()
+        # id of a resolved node -> [(name, child node, whether it's a State)]
+        self.children = dict()
+
+    def build(self) -> Object:
+        return self.create(self.spec, self.spec.get('name'))
+
+    def resolve(self, node: Dict) -> Dict:
+        """Merge a node with its type"""
+        type_name = node.get('type')
+        if type_name is None:
+            return node
+        merged = self.resolved.get(id(node))
+        if merged is None:
+            base = self.resolve(self.types[type_name])
+            merged = dict(base, **node)
+            merged['children'] = dict(base.get('children', {}), **node.get('children', {}))
+            merged['links'] = base.get('links', []) + node.get('links', [])
+            merged['class'] = node.get('class', base.get('class', type_name))
+            self.resolved[id(node)] = merged
+        return merged
+
+    def create(self, node: Dict, name: str=None):
+        node = self.resolve(node)
+
+        states = node.get('state')
+        if states is not None:
+            schema = self.schemas[states] if type(states) is str else StateSchema.get(states)
+            return State(schema, node.get('default'), name)
+
+        cls = self.classes.get(node.get('class'), Object)
+        obj = cls(name=name) if name is not None else cls()
+
+        eager = dict()
+        for child_name, child, is_state in self.expand(node):
+            if self.lazy and not is_state:
+                obj._aios_add_lazy(child_name, self.factory(child))
+            else:
+                eager[child_name] = self.create(child, child_name)
+        obj._aios_add_children(eager)
+
+        self.link(obj, node.get('links', ()))
+        return obj
+
+    def expand(self, node: Dict):
+        """Return the (name, node, whether it's a State) of each child of a resolved node, with repeats expanded"""
+        children = self.children.get(id(node))
+        if children is None:
+            children = self.children[id(node)] = []
+            for child_name, child in node.get('children', {}).items():
+                is_state = 'state' in self.resolve(child)
+                repeat = child.get('repeat')
+                for _ in [child_name] if repeat is None else range(repeat):
+                    children.append((child_name if repeat is None else child_name.format(_), child, is_state))
+        return children
+
+    def factory(self, node: Dict) -> Callable:
+        return lambda: self.create(node)
+
+    def link(self, obj: Object, links):
+        """Wire links, with one set_input call per dest State and priority"""
+        inputs = dict()
+        for link in links:
+            dest, dest_state, source, source_state = link[:4]
+            priority = link[4] if len(link) > 4 else 0
+            key = (_child(obj, dest), priority)
+            inputs.setdefault(key, dict()).setdefault(dest_state, []).append((_child(obj, source), source_state))
+
+        for (dest, priority), state_map in inputs.items():
+            dest.set_input(state_map, priority)
+
+
+def _child(obj: Object, path: str):
+    """The object or State at a path below obj, without indexing obj's hierarchy (see Object._aios_lookup)"""
+    for name in path.split('.'):
+        obj = getattr(obj, name)
+    return obj
+
+
+def build(spec: Dict, classes: Dict[str, type]=None, lazy: bool=True) -> Object:
+    """
+    Build an Object hierarchy from a spec. classes maps type names to Object subclasses
+    to use for nodes of that type (or with that "class"). With lazy=False, every Object
+    is created up front.
+
+    >>> spec = {
+    ...     'name': 'site',
+    ...     'schemas': {'door': ['open', 'closed'], 'switch': ['on', 'off']},
+    ...     'types': {
+    ...         'room': {
+    ...             'children': {
+    ...                 'door': {'state': 'door', 'default': 'closed'},
+    ...                 'light': {'state': 'switch', 'default': 'off'}},
+    ...             'links': [['light', 'on', 'door', 'open'], ['light', 'off', 'door', 'closed']]},
+    ...         'floor': {'children': {'room{}': {'type': 'room', 'repeat': 1000}}}},
+    ...     'children': {
+    ...         'floor{}': {'type': 'floor', 'repeat': 100},
+    ...         'alarm': {'state': ['ringing', 'silent'], 'default': 'silent'}},
+    ...     'links': [['alarm', 'ringing', 'floor0.room0.door', 'open']]}
+    >>> site = build(spec)
+    >>> site.floor7.room99.door.open = True
+    >>> print(site.floor7.room99)
+    <site.floor7.room99 door=[OPEN, closed] light=[ON, off]>
+    >>> site.floor0.room0.door.open = True
+    >>> print(site.alarm)
+    alarm=[RINGING, silent]
+
+    Only the floors and rooms which have been used have been created (rather than
+    the 300,101 objects and States in the whole hierarchy)
+
+    >>> sum(1 for _ in site._aios_walk(expand=False))
+    9
+    >>> site.floor7.room99.door.schema is site.floor0.room0.door.schema
+    True
+
+    load() builds from a JSON string or file.
+    """
+    return Loader(spec, classes, lazy).build()
+
+
+def load(source, classes: Dict[str, type]=None, lazy: bool=True) -> Object:
+    """Build an Object hierarchy from a JSON spec, given as a string or a file object"""
+    spec = json.loads(source) if isinstance(source, str) else json.load(source)
+    return build(spec, classes, lazy)
@@ -3,8 +3,11 @@ import asyncio
 import time
 import inspect
 import collections
+import contextvars
 from typing import Dict, Any, List, Callable
 
+from .propagation import CancelToken, FrozenError, Plan, Propagation
+
 logger = logging.getLogger('aios.state')
 
 # notify
@@ -17,6 +20,202 @@ logger = logging.getLogger('aios.state')
 # release lock
 
 
+async def _gather(coros: List, timeout: float=None):
+    """Run coroutines concurrently, each limited to timeout, returning results or exceptions"""
+    return await asyncio.gather(*(asyncio.wait_for(_, timeout) for _ in coros), return_exceptions=True)
+
+
+def _raise_first(results: List):
+    for _ in results:
+        if isinstance(_, BaseException):
+            raise _
+
+
+# output class -> whether it has a blocking() method
+_blocking_types = dict()
+
+
+def _blocking(obj) -> bool:
+    cls = type(obj)
+    defined = _blocking_types.get(cls)
+    if defined is None:
+        defined = _blocking_types[cls] = callable(getattr(cls, 'blocking', None))
+    return defined and obj.blocking()
+
+
+async def _offload(func, *args):
+    """Call func in State.executor, in a copy of the current context (so it can join the running propagation)"""
+    context = contextvars.copy_context()
+    return await asyncio.get_event_loop().run_in_executor(State.executor, context.run, func, *args)
+
+
+class BlockingOutput(object):
+    """
+    Wraps a sync output which declares itself blocking, so change_state_async runs its
+    calls in State.executor (the event loop's default executor if None) rather than on
+    the event loop. The locks are still taken, changed and released in the same order,
+    and released if any lock can't be acquired.
+
+    >>> import time
+    >>> from aios.object import Object
+    >>> class SerialPort(object):
+    ...     def __init__(self):
+    ...         self._lock = None
+    ...         self.current_state = None
+    ...     def acquire_lock(self, new_state):
+    ...         if self._lock is not None:
+    ...             raise Exception('Change not allowed')
+    ...         self._lock = new_state
+    ...     def change(self):
+    ...         time.sleep(0.2)
+    ...         self.current_state = self._lock
+    ...     def release_lock(self):
+    ...         self._lock = None
+    ...     def require_async(self):
+    ...         return False
+    ...     def blocking(self):
+    ...         return True
+    >>> system = Object(name='system', children={'fan': State(['on', 'off'], default='off')})
+    >>> port = SerialPort()
+    >>> system.fan.set_output(port)
+    >>> async def latency():
+    ...     worst = 0
+    ...     for _ in range(10):
+    ...         start = time.monotonic()
+    ...         await asyncio.sleep(0.01)
+    ...         worst = max(worst, time.monotonic() - start - 0.01)
+    ...     return worst
+    >>> async def main():
+    ...     results = await asyncio.gather(system.fan.change_state_async('on'), latency())
+    ...     return results[1]
+    >>> loop = asyncio.get_event_loop()
+    >>> loop.run_until_complete(main()) < 0.05
+    True
+    >>> print(system.fan, port.current_state, port._lock)
+    fan=[ON, off] on None
+
+    Sync changes still call blocking outputs directly
+
+    >>> system.fan.off = True
+    >>> port.current_state
+    'off'
+
+    A call can't be interrupted once it's running in a thread, so if acquire_lock is
+    cut short by a timeout (or a deadline or CancelToken - see change_state_async),
+    the lock is released once the call finishes :-
+
+    >>> class SlowPort(SerialPort):
+    ...     def acquire_lock(self, new_state):
+    ...         time.sleep(0.3)
+    ...         super().acquire_lock(new_state)
+    >>> pump = State(['on', 'off'], name='pump', default='off')
+    >>> slow = SlowPort()
+    >>> pump.set_output(slow)
+    >>> try:
+    ...     loop.run_until_complete(pump.change_state_async('on', concurrent=True, timeout=0.1))
+    ... except asyncio.TimeoutError:
+    ...     print('timed out')
+    timed out
+    >>> print(pump, slow._lock)
+    pump=[on, OFF] None
+    >>> try:
+    ...     loop.run_until_complete(pump.change_state_async('on', deadline=loop.time() + 0.1))
+    ... except asyncio.TimeoutError:
+    ...     print('timed out')
+    timed out
+    >>> print(pump, slow._lock)
+    pump=[on, OFF] None
+    >>> loop.run_until_complete(pump.change_state_async('on'))
+    >>> print(pump, slow._lock)
+    pump=[ON, off] None
+    """
+
+    __slots__ = ('output',)
+
+    def __init__(self, output):
+        self.output = output
+
+    def require_async(self):
+        return True
+
+    async def acquire_lock(self, new_state):
+        future = asyncio.ensure_future(_offload(self.output.acquire_lock, new_state))
+        try:
+            await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # the call carries on in its thread, so undo the lock once it's taken
+            await asyncio.shield(self._abandon(future))
+            raise
+
+    async def _abandon(self, future: asyncio.Future):
+        """Wait for an abandoned acquire_lock call to finish, and release the lock if it was acquired"""
+        await asyncio.wait([future])
+        if not future.cancelled() and future.exception() is None:
+            await _offload(self.output.release_lock)
+
+    async def change(self):
+        await _offload(self.output.change)
+
+    async def release_lock(self):
+        await _offload(self.output.release_lock)
+
+
+class StateSchema(object):
+    """
+    The vocabulary of a State - an immutable, ordered set of lower-case state names.
+
+    Schemas are interned, so every State with the same states shares one schema, and
+    each State only stores the index of its current state :-
+
+    >>> a = State(['online', 'offline'], name='a')
+    >>> b = State(['online', 'offline'], name='b', default='offline')
+    >>> a.schema is b.schema
+    True
+    >>> b.schema.index['offline'], list(b.schema)
+    (1, ['online', 'offline'])
+    >>> 'online' in a.states
+    True
+    """
+
+    __slots__ = ('states', 'index')
+
+    cache = dict()
+
+    def __init__(self, states: List):
+        assert all(map(lambda _:_ == _.lower(), states)), 'states must be lower-case'
+        object.__setattr__(self, 'states', tuple(states))
+        object.__setattr__(self, 'index', {state: idx for idx, state in enumerate(states)})
+        assert len(self.index) == len(self.states), 'states must be unique'
+
+    @classmethod
+    def get(cls, states) -> 'StateSchema':
+        if type(states) is cls:
+            return states
+        key = tuple(states)
+        try:
+            return cls.cache[key]
+        except KeyError:
+            schema = cls.cache[key] = cls(states)
+            return schema
+
+    def __setattr__(self, key, value):
+        raise AttributeError('StateSchema is immutable')
+
+    def __contains__(self, state):
+        return state in self.index
+
+    def __iter__(self):
+        return iter(self.states)
+
+    def __len__(self):
+        return len(self.states)
+
+    def __getitem__(self, idx):
+        return self.states[idx]
+
+    def __repr__(self):
+        return 'StateSchema({})'.format(list(self.states))
+
 
 class State(object):
     """
@@ -49,25 +248,131 @@ class State(object):
     >>> system.connectivity = 'offline'
     >>> print(system)
     <System connectivity=[online, OFFLINE]>
+
+    States with the same list of states share a StateSchema, and the linking
+    and output containers are only created once they're used, so a large number
+    of States is cheap to keep in memory.
     """
     post_change_callback_maps: Dict['State', Dict]
 
-    def __init__(self,  states: List =None, default: str=None, name=None):
-        assert type(states) is list
-        assert all(map(lambda _:_ == _.lower(), states)), 'states must be lower-case'
-        self.states = states
-        self.output_callbacks = set()
-        self.post_change_callbacks = collections.defaultdict(list)
-        self.__name__ = name
-        if default is not None:
-            assert default in self.states
-            self.current_state = default
-        else:
-            self.current_state = None
+    __slots__ = ('_schema', '_index', '_outputs', '_output_ids', '_callbacks', '_inputs', '_priorities', '_frozen',
+                 '_plans', 'async_required', '__name__', '__parent__', '__weakref__')
+
+    _private = frozenset(('_schema', '_index', '_outputs', '_output_ids', '_callbacks', '_inputs', '_priorities',
+                          '_frozen', '_plans'))
+
+    # callables called with (state, old_index, new_index) after every transition - see aios.registry
+    observers = []
+
+    # set by aios.metrics.Metrics.enable
+    metrics = None
+
+    # set by aios.journal.Journal.enable
+    journal = None
+
+    # set by aios.locking.Locking.enable
+    locking = None
+
+    # concurrent.futures.Executor for the calls to blocking outputs from change_state_async -
+    # None for the event loop's default executor. See BlockingOutput
+    executor = None
 
+    # bumped by set_input and set_output, so cached plans can tell that the graph has changed
+    generation = 0
 
-    # def __hash__(self):
-    #     return hash(self.__name__) + hash(self.__parent__)
+    # the most plans cached per (State, new_state) - see plan()
+    plans_cached = 16
+
+    def __init__(self,  states: List =None, default: str=None, name=None):
+        assert type(states) in (list, StateSchema)
+        schema = StateSchema.get(states)
+        assert default is None or default in schema
+        # set directly rather than through __setattr__, as a large hierarchy creates a lot of States
+        init = object.__setattr__
+        init(self, '_schema', schema)
+        init(self, '_index', None if default is None else schema.index[default])
+        init(self, '_outputs', None)
+        # ids of the outputs, so set_output can tell if one has been added already
+        init(self, '_output_ids', None)
+        init(self, '_callbacks', None)
+        init(self, '_inputs', None)
+        # output or (state, dest State, dest state) link -> priority, for those which aren't 0
+        init(self, '_priorities', None)
+        # the aios.frozen.FrozenGraph this State is part of, if any
+        init(self, '_frozen', None)
+        # new_state -> (generation, the States its plan depends on, their indices -> Plan)
+        init(self, '_plans', None)
+        init(self, 'async_required', False)
+        init(self, '__name__', name)
+
+    # identity, as __eq__ compares the current state
+    __hash__ = object.__hash__
+
+    @property
+    def schema(self) -> 'StateSchema':
+        return self._schema
+
+    @property
+    def states(self) -> 'StateSchema':
+        return self._schema
+
+    @property
+    def current_state(self) -> str:
+        index = self._index
+        return None if index is None else self._schema.states[index]
+
+    @current_state.setter
+    def current_state(self, new_state: str):
+        self._index = None if new_state is None else self._schema.index[new_state]
+
+    @property
+    def output_callbacks(self) -> List:
+        if self._outputs is None:
+            self._outputs = []
+        return self._outputs
+
+    @property
+    def post_change_callbacks(self) -> Dict[str, List]:
+        if self._callbacks is None:
+            self._callbacks = collections.defaultdict(list)
+        return self._callbacks
+
+    @property
+    def input_states(self) -> set:
+        if self._inputs is None:
+            self._inputs = set()
+        return self._inputs
+
+    def _commit(self, new_state: str):
+        old = self._index
+        self._index = index = self._schema.index[new_state]
+        for observer in State.observers:
+            observer(self, old, index)
+
+    def downstream(self, new_state: str):
+        """Return the (State, state) pairs linked to new_state by set_input"""
+        callbacks = self._callbacks
+        if callbacks is None:
+            return ()
+        return callbacks.get(new_state, ())
+
+    def priority(self, key, default: int=0) -> int:
+        """Return the priority of an output, or of a (state, dest State, dest state) link"""
+        priorities = self._priorities
+        if priorities is None:
+            return default
+        return priorities.get(key, default)
+
+    def _prioritise(self, items: List, item, key: Callable, priority: int):
+        """Insert item into items after any with the same or a higher priority - key(item) is its key in priority()"""
+        if priority:
+            if self._priorities is None:
+                self._priorities = dict()
+            self._priorities[key(item)] = priority
+        position = len(items)
+        while position and self.priority(key(items[position - 1])) < priority:
+            position -= 1
+        items.insert(position, item)
 
     def __getattr__(self, item):
         """
@@ -88,33 +393,57 @@ class State(object):
         (test=[ONE, two], 'one')
 
         """
-        if item.lower() not in self.__getattribute__('states'):
-            raise AttributeError()
+        index = object.__getattribute__(self, '_schema').index.get(item.lower())
+        if index is None:
+            raise AttributeError(item)
 
         if item.isupper():
-            if item.lower() == self.__getattribute__('current_state'):
-                return True
-            else:
-                return False
+            return index == self._index
         elif item.islower():
             return (self, item)
         else:
-            raise AttributeError()
+            raise AttributeError(item)
 
     def check_change_state(self, new_state: str, source: 'State'=None):
-        assert new_state in getattr(self, 'states', [])
-        cs = getattr(self, 'current_state', None)
+        """
+        Return True if new_state isn't the current state, logging the change at debug level.
+        An Object source is logged by its qualified name, so logging doesn't render (or
+        create the lazy children of) the hierarchy below it
+
+        >>> import io
+        >>> from aios.object import Object
+        >>> site = Object(name='site', children={'alarm': State(['ringing', 'silent'], default='silent')})
+        >>> site._aios_add_lazy('b1', Object)
+        >>> stream = io.StringIO()
+        >>> handler = logging.StreamHandler(stream)
+        >>> logger.addHandler(handler)
+        >>> logger.setLevel(logging.DEBUG)
+        >>> site.alarm.change_state('ringing', source=site)
+        >>> logger.removeHandler(handler)
+        >>> logger.setLevel(logging.NOTSET)
+        >>> print(stream.getvalue().strip())
+        alarm: silent -> ringing (Source: site)
+        >>> list(site._aios_lazy)
+        ['b1']
+        """
+        assert new_state in self._schema
+        cs = self.current_state
         if new_state == cs:
             return False
 
-        if source is None:
-            logger.debug('{}: {} -> {}'.format(self.__name__, cs, new_state))
-        else:
-            logger.debug('{}: {} -> {} (Source: {})'.format(self.__name__, cs, new_state, source))
+        if logger.isEnabledFor(logging.DEBUG):
+            if source is None:
+                logger.debug('{}: {} -> {}'.format(self.__name__, cs, new_state))
+            else:
+                qualified_name = getattr(source, '_aios_qualified_name', None)
+                logger.debug('{}: {} -> {} (Source: {})'.format(
+                    self.__name__, cs, new_state, source if qualified_name is None else qualified_name()))
 
         return True
 
-    async def change_state_async(self, new_state: str, source: 'State'=None):
+    async def change_state_async(self, new_state: str, source: 'State'=None,
+                                 concurrent: bool=False, timeout: float=None,
+                                 deadline: float=None, token: CancelToken=None, supersede: bool=False):
         """
 
         >>> from aios.object import Object
@@ -144,66 +473,287 @@ class State(object):
         >>> loop.run_until_complete(system.connectivity.change_state_async('online'))
         >>> print(system.connectivity)
         connectivity=[offline, ONLINE]
+
+        By default each phase (acquire_lock, change, release_lock) is awaited on one
+        async output at a time. With concurrent=True each phase runs across all of
+        the outputs at once, so a transition takes as long as the slowest output
+        rather than the sum of them. timeout (in seconds) limits each phase.
+
+        >>> import time
+        >>> class SlowOutput(GPIO_Async):
+        ...     async def change(self):
+        ...         await asyncio.sleep(0.05)
+        ...         self.current_state = self._lock
+        >>> system = Object(name='system', children={'connectivity': State(['offline', 'online'])})
+        >>> outputs = [SlowOutput() for _ in range(10)]
+        >>> for _ in outputs:
+        ...     system.connectivity.set_output(_)
+        >>> start = time.monotonic()
+        >>> loop.run_until_complete(system.connectivity.change_state_async('offline', concurrent=True, timeout=5))
+        >>> time.monotonic() - start < 0.25
+        True
+        >>> all(_.current_state == 'offline' for _ in outputs)
+        True
+
+        If any lock can't be acquired, the locks which were taken are released and
+        the state doesn't change
+
+        >>> outputs[3]._lock = 'busy'
+        >>> loop.run_until_complete(system.connectivity.change_state_async('online', concurrent=True))
+        Traceback (most recent call last):
+        ...
+        Exception: Change not allowed
+        >>> [_._lock for _ in outputs if _._lock is not None]
+        ['busy']
+        >>> print(system.connectivity)
+        connectivity=[OFFLINE, online]
+
+        The options apply to every State the change propagates to. If called while a
+        propagation is already running, the change is queued with that propagation
+        and these options are ignored.
+
+        deadline (in event loop time) limits the whole transition, including everything
+        downstream of it, and token (a CancelToken) cancels it. Either way the outputs
+        being awaited are cancelled and their locks released, and the transition raises
+        asyncio.TimeoutError or TransitionCancelled. With supersede=True, a transition
+        cancels the one still in flight from the last call with supersede on this State
+        (and waits for its locks to be released), so the latest intent wins :-
+
+        >>> gpio = GPIO_Async()
+        >>> connectivity = State(['offline', 'online'], name='connectivity', default='offline')
+        >>> connectivity.set_output(gpio)
+        >>> async def flap():
+        ...     online = asyncio.ensure_future(connectivity.change_state_async('online', supersede=True))
+        ...     await asyncio.sleep(0.1)
+        ...     await connectivity.change_state_async('offline', supersede=True)
+        ...     return (await asyncio.gather(online, return_exceptions=True))[0]
+        >>> start = time.monotonic()
+        >>> loop.run_until_complete(flap())
+        TransitionCancelled('Transition cancelled')
+        >>> print(connectivity, gpio.current_state, gpio._lock)
+        connectivity=[OFFLINE, online] None None
+        >>> time.monotonic() - start < 0.5
+        True
+        >>> try:
+        ...     loop.run_until_complete(connectivity.change_state_async('online', deadline=loop.time() + 0.1))
+        ... except asyncio.TimeoutError:
+        ...     print('timed out')
+        timed out
+        >>> print(connectivity, gpio._lock)
+        connectivity=[OFFLINE, online] None
+
+        Locks already acquired are released when the deadline passes, even with
+        concurrent=True while other outputs are still being locked :-
+
+        >>> class SlowLock(GPIO_Async):
+        ...     def __init__(self, delay):
+        ...         super().__init__()
+        ...         self.delay = delay
+        ...     async def acquire_lock(self, new_state):
+        ...         await asyncio.sleep(self.delay)
+        ...         await super().acquire_lock(new_state)
+        >>> fast, slow = SlowLock(0.01), SlowLock(0.5)
+        >>> pump = State(['on', 'off'], name='pump', default='off')
+        >>> pump.set_output(fast)
+        >>> pump.set_output(slow)
+        >>> try:
+        ...     loop.run_until_complete(pump.change_state_async('on', concurrent=True, deadline=loop.time() + 0.1))
+        ... except asyncio.TimeoutError:
+        ...     print('timed out')
+        timed out
+        >>> print(pump, fast._lock, slow._lock)
+        pump=[on, OFF] None None
         """
+        propagation = Propagation.active()
+        if propagation is not None:
+            propagation.add(self, new_state, source)
+            return
+
+        propagation = Propagation(concurrent=concurrent, timeout=timeout, deadline=deadline, token=token)
+        if supersede:
+            await propagation.supersede(self)
+        try:
+            await propagation.add(self, new_state, source).run_async()
+        finally:
+            if supersede:
+                propagation.superseded(self)
+        if State.journal is not None:
+            await State.journal.commit_async()
+
+    async def _apply_async(self, new_state: str, source: 'State'=None,
+                           concurrent: bool=False, timeout: float=None):
+        """Enact a single transition on this State's outputs, without propagating it"""
         if not self.check_change_state(new_state, source):
             return
 
+        locked, locked_async = await self._acquire_async(new_state, concurrent, timeout)
+        try:
+            await self._enact_async(new_state, locked, locked_async, concurrent, timeout)
+        finally:
+            await self._release_async(locked, locked_async, concurrent, timeout)
+
+    async def _acquire_async(self, new_state: str, concurrent: bool=False, timeout: float=None):
+        """
+        Acquire the locks of this State's outputs, returning (sync outputs, async outputs) -
+        or release those acquired and raise. With concurrent, the async outputs are locked at once.
+        """
+        outputs = self._outputs or ()
+        if State.metrics is not None:
+            outputs = State.metrics.wrap(self, outputs)
+        outputs = [BlockingOutput(_) if _blocking(_) else _ for _ in outputs]
+
         locked = []
         locked_async = []
-        for obj in self.output_callbacks:
-
-            try:
-                if obj.require_async():
-                    await obj.acquire_lock(new_state)
-                    locked_async.append(obj)
-                else:
+        outputs_async = []
+        try:
+            for obj in outputs:
+                if not obj.require_async():
                     obj.acquire_lock(new_state)
                     locked.append(obj)
-            except:
-                for _ in locked:
-                    _.release_lock()
-                for _ in locked_async:
-                    await _.release_lock()
-                raise
+                elif concurrent:
+                    outputs_async.append(obj)
+                else:
+                    await obj.acquire_lock(new_state)
+                    locked_async.append(obj)
 
+            if outputs_async:
+                tasks = [asyncio.ensure_future(asyncio.wait_for(_.acquire_lock(new_state), timeout))
+                         for _ in outputs_async]
+                try:
+                    await asyncio.gather(*tasks, return_exceptions=True)
+                finally:
+                    # the acquires which finished, even if cancelled (eg at a deadline) while waiting for the others
+                    locked_async = [obj for obj, task in zip(outputs_async, tasks)
+                                    if task.done() and not task.cancelled() and task.exception() is None]
+                _raise_first([_.exception() for _ in tasks])
+        except BaseException:
+            await asyncio.shield(self._release_async(locked, locked_async, concurrent, timeout))
+            raise
+        return locked, locked_async
+
+    async def _enact_async(self, new_state: str, locked: List, locked_async: List,
+                           concurrent: bool=False, timeout: float=None):
+        """Change the locked outputs and commit new_state"""
         for _ in locked:
             _.change()
+        if concurrent:
+            _raise_first(await _gather([_.change() for _ in locked_async], timeout))
+        else:
+            for _ in locked_async:
+                await _.change()
 
-        for _ in locked_async:
-            await _.change()
-
-        for dest, dest_state in self.post_change_callbacks[new_state]:
-            await dest.change_state_async(dest_state, self)
-
-        self.current_state = new_state
+        self._commit(new_state)
 
+    async def _release_async(self, locked: List, locked_async: List, concurrent: bool=False, timeout: float=None):
         for _ in locked:
             _.release_lock()
-        for _ in locked_async:
-            await _.release_lock()
-
+        if concurrent:
+            _raise_first(await _gather([_.release_lock() for _ in locked_async], timeout))
+        else:
+            for _ in locked_async:
+                await _.release_lock()
 
     def check_for_async(self):
+        """
+        Assert that neither this State nor any State downstream of it has an output
+        which requires awaiting.
+
+        The answer is cached in async_required and kept up to date by set_input and
+        set_output, so the check doesn't walk the graph :-
+
+        >>> class AsyncOutput(object):
+        ...     async def acquire_lock(self, new_state): pass
+        ...     async def change(self): pass
+        ...     async def release_lock(self): pass
+        ...     def require_async(self): return True
+        >>> A = State(['on', 'off'], name='A')
+        >>> B = State(['on', 'off'], name='B')
+        >>> C = State(['on', 'off'], name='C')
+        >>> B.on = A.on
+        >>> C.on = B.on
+        >>> A.check_for_async()
+        >>> C.set_output(AsyncOutput())
+        >>> A.async_required, B.async_required, C.async_required
+        (True, True, True)
+        >>> A.check_for_async()
+        Traceback (most recent call last):
+        ...
+        AssertionError: At least one of the output callbacks requires awaiting - use change_state_async instead.
+        """
 
-        assert all(_.require_async() is False for _ in self.output_callbacks), \
+        assert not self.async_required, \
             "At least one of the output callbacks requires awaiting - use change_state_async instead."
 
-        checked = list()
-        for new_state in self.post_change_callbacks:
-            for dest, dest_state in self.post_change_callbacks[new_state]:
-                if dest in checked:
-                    continue
-                dest.check_for_async()
-                checked.append(dest)
+    def _mark_async(self):
+        """Flag this State and every State upstream of it as requiring change_state_async"""
+
+        pending = [self]
+        while pending:
+            state = pending.pop()
+            if state.async_required:
+                continue
+            state.async_required = True
+            pending.extend(state._inputs or ())
 
     def change_state(self, new_state: str, source: 'State'=None):
+        """
+        Change state and propagate the change to any linked States. See aios.propagation
+
+        If called while a propagation is already running (eg from an output's change()),
+        the change is queued and enacted by that propagation rather than immediately.
+
+        The outputs of every State a change propagates to are locked before any of them
+        are changed, so if one refuses its lock, none of the States change :-
+
+        >>> class Refuse(object):
+        ...     def acquire_lock(self, new_state):
+        ...         raise Exception('Change not allowed')
+        ...     def change(self): pass
+        ...     def release_lock(self): pass
+        ...     def require_async(self): return False
+        >>> A = State(['open', 'closed'], name='A', default='closed')
+        >>> B = State(['on', 'off'], name='B', default='off')
+        >>> B.on = A.open
+        >>> B.set_output(Refuse())
+        >>> A.open = True
+        Traceback (most recent call last):
+        ...
+        Exception: Change not allowed
+        >>> print(A, B)
+        A=[open, CLOSED] B=[on, OFF]
+
+        Changes queued by outputs are enacted in later rounds, after the States before
+        them have changed.
+        """
+        propagation = Propagation.active()
+        if propagation is not None:
+            propagation.add(self, new_state, source)
+            return
+
+        Propagation().add(self, new_state, source).run()
+        if State.journal is not None:
+            State.journal.commit()
+
+    def _apply(self, new_state: str, source: 'State'=None):
+        """Enact a single transition on this State's outputs, without propagating it"""
         if not self.check_change_state(new_state, source):
             return
 
-        self.check_for_async()
+        locked = self._acquire(new_state)
+        try:
+            self._enact(new_state, locked)
+        finally:
+            for _ in locked:
+                _.release_lock()
+
+    def _acquire(self, new_state: str) -> List:
+        """Acquire the locks of this State's outputs, returning them - or release those acquired and raise"""
+        outputs = self._outputs or ()
+        if State.metrics is not None:
+            outputs = State.metrics.wrap(self, outputs)
 
         locked = []
-        for obj in self.output_callbacks:
+        for obj in outputs:
             try:
                 obj.acquire_lock(new_state)
                 locked.append(obj)
@@ -211,28 +761,98 @@ class State(object):
                 for _ in locked:
                     _.release_lock()
                 raise
+        return locked
 
-        for _ in self.output_callbacks:
-             _.change()
-
-        for dest, dest_state in self.post_change_callbacks[new_state]:
-            dest.change_state(dest_state, self)
+    def _enact(self, new_state: str, locked: List):
+        """Change the locked outputs and commit new_state"""
+        for _ in locked:
+            _.change()
 
-        self.current_state = new_state
+        self._commit(new_state)
 
-        for _ in self.output_callbacks:
-            _.release_lock()
+    def plan(self, new_state: str) -> Plan:
+        """
+        Return the Plan for changing to new_state - the transitions it would propagate
+        to, in the order they'd be applied, and the acquire_lock calls each would make -
+        without changing anything.
+
+        >>> door = State(['open', 'closed'], name='door', default='closed')
+        >>> light = State(['on', 'off'], name='light', default='off')
+        >>> alarm = State(['ringing', 'silent'], name='alarm', default='silent')
+        >>> light.on = door.open
+        >>> alarm.ringing = light.on
+        >>> plan = door.plan('open')
+        >>> [(_.__name__, new_state) for _, new_state in plan.transitions]
+        [('door', 'open'), ('light', 'on'), ('alarm', 'ringing')]
+        >>> print(door, light, alarm)
+        door=[open, CLOSED] light=[on, OFF] alarm=[ringing, SILENT]
+
+        Plans are cached for the current states of the States they depend on, and for
+        the current links and outputs (any set_input or set_output drops them), so a
+        repeated plan is a lookup :-
+
+        >>> door.plan('open') is plan
+        True
+        >>> alarm.ringing = True
+        >>> [_.__name__ for _, new_state in door.plan('open').transitions]
+        ['door', 'light']
+        >>> light.on = True
+        >>> [_.__name__ for _, new_state in door.plan('open').transitions]
+        ['door']
+        >>> light.off = True
+        >>> alarm.silent = True
+        >>> [_.__name__ for _, new_state in door.plan('open').transitions]
+        ['door', 'light', 'alarm']
+        >>> alarm.ringing = True
+        >>> [_.__name__ for _, new_state in door.plan('open').transitions]
+        ['door', 'light']
+
+        Changes made by outputs when a plan is applied (eg by a ConditionalInputOutput)
+        aren't part of the plan, as they can't be known without calling the outputs.
+        """
+        assert new_state in self._schema
+        generation = State.generation
+        cached = self._plans
+        if cached is not None:
+            entry = cached.get(new_state)
+            if entry is not None and entry[0] == generation:
+                plan = entry[2].get(tuple([_._index for _ in entry[1]]))
+                if plan is not None:
+                    return plan
+
+        visited = set()
+        planned = Propagation().add(self, new_state).plan(visited)
+        transitions = tuple((state, state_name) for state, state_name, _, _, _ in planned.values())
+        locks = tuple((obj, state_name) for state, state_name in transitions for obj in state._outputs or ())
+        plan = Plan(transitions, locks)
+
+        if cached is None:
+            cached = self._plans = dict()
+        entry = cached.get(new_state)
+        # a plan is keyed on the States it looked at, or more - if it looked at others, start again
+        if entry is None or entry[0] != generation or len(entry[2]) >= self.plans_cached or \
+                not visited.issubset(entry[1]):
+            entry = cached[new_state] = (generation, frozenset(visited), dict())
+        entry[2][tuple([_._index for _ in entry[1]])] = plan
+        return plan
+
+    def changes(self, maxsize: int=1000, policy: str='drop-oldest'):
+        """Return an async iterator of the changes to this State - see aios.stream.Subscription"""
+        from aios.stream import Subscription
+        return Subscription(self, maxsize, policy)
 
     def __set__(self, instance, value):
         self.change_state(value, instance)
 
     def __setattr__(self, key, value):
-        if key.lower() in getattr(self, 'states', []):
+        if key in self._private:
+            object.__setattr__(self, key, value)
+        elif key.lower() in self._schema:
 
             if self.check_state_tuple(value):
                 self.set_input({key: value})
             elif type(value) is list and all(self.check_state_tuple(_) for _ in value):
-                map(lambda _:self.set_input({_[0]:_[1]}), value)
+                self.set_input({key.lower(): value})
             else:
                 self.change_state(key.lower())
                 assert bool(value)
@@ -240,11 +860,11 @@ class State(object):
             super().__setattr__(key, value)
 
     def __repr__(self):
-        states = map(lambda _:_.lower() if _ != self.current_state else _.upper(), self.states)
+        states = map(lambda _:_.lower() if _ != self.current_state else _.upper(), self._schema)
         return '{}=[{}]'.format(self.__name__, ', '.join(states))
 
     def __eq__(self, other):
-        if other in self.states:
+        if type(other) is str and other in self._schema:
             return other == self.current_state
         return super().__eq__(other)
 
@@ -252,7 +872,7 @@ class State(object):
     def check_state_tuple(t):
         return type(t) is tuple and isinstance(t[0], State) and type(t[1]) is str
 
-    def set_input(self, state_map: Dict):
+    def set_input(self, state_map: Dict, priority: int=0):
         """
         You can also connect states together by setting one state object as the input for another
 
@@ -297,8 +917,25 @@ class State(object):
         >>> print(very_remote.alarm)
         alarm=[disarmed, ARMED]
 
+        Assigning a list links every State in it
+
+        >>> a = State(['on', 'off'], name='a', default='off')
+        >>> b = State(['on', 'off'], name='b', default='off')
+        >>> both = State(['on', 'off'], name='both', default='off')
+        >>> both.on = [a.on, b.on]
+        >>> b.on = True
+        >>> print(both)
+        both=[ON, off]
+        >>> [_.__name__ for _ in sorted(both.input_states, key=lambda _: _.__name__)]
+        ['a', 'b']
+
+        A propagation changes linked States in priority order (higher first), and in the
+        order they were linked for the same priority. The priority of a link applies to
+        everything downstream of it, unless set again further down. See set_output
+
         """
 
+        State.generation += 1
         for state, sources in state_map.items():
 
             if type(sources) is tuple:
@@ -306,12 +943,18 @@ class State(object):
             all(self.check_state_tuple(_) for _ in sources)
 
             for dest, dest_state in sources:
-                dest.post_change_callbacks[dest_state].append((self, state))
+                if self._frozen is not None or dest._frozen is not None:
+                    raise FrozenError('Can\'t link {} to {} - the graph is frozen'.format(self.__name__, dest.__name__))
+                dest._prioritise(dest.post_change_callbacks[dest_state], (self, state),
+                                 lambda _: (dest_state,) + _, priority)
+                self.input_states.add(dest)
+                if self.async_required:
+                    dest._mark_async()
 
 
 
 
-    def set_output(self, obj):
+    def set_output(self, obj, priority: int=0):
         """Changes to the State object output using a class that has the following methods:
 
         All of these functions should be non-blocking.
@@ -337,6 +980,13 @@ class State(object):
 
         Indicate if the calls are async or not. See change_state_async()
 
+        This is only checked once, when the output is added.
+
+        - blocking() (optional)
+
+        For sync outputs which can block (eg writing to a serial port) - if it returns
+        True, change_state_async runs the calls in an executor. See BlockingOutput
+
         >>> from aios.object import Object
         >>> class GPIO(object):
         ...     def __init__(self):
@@ -356,6 +1006,12 @@ class State(object):
         >>> gpio = GPIO()
         >>> system.connectivity.set_output(gpio)
 
+        Adding the same output again does nothing
+
+        >>> system.connectivity.set_output(gpio)
+        >>> len(system.connectivity.output_callbacks)
+        1
+
         Note, that if you haven't defined a default for your State object, it starts in an
         "undefined" state (where no state is considered active) :-
 
@@ -375,13 +1031,51 @@ class State(object):
         Exception: Change not allowed
         >>> system.connectivity == 'offline'
         True
+
+        Outputs are called in priority order (higher first), then in the order they were
+        added. Links from set_input have priorities too, so a critical output isn't kept
+        waiting by any number of low priority ones :-
+
+        >>> class Recorder(GPIO):
+        ...     def __init__(self, name, log):
+        ...         super().__init__()
+        ...         self.name, self.log = name, log
+        ...     def change(self):
+        ...         self.log.append(self.name)
+        >>> log = []
+        >>> door = State(['open', 'closed'], name='door', default='closed')
+        >>> siren = State(['on', 'off'], name='siren', default='off')
+        >>> for i in range(3):
+        ...     door.set_output(Recorder('ui{}'.format(i), log))
+        ...     ui = State(['open', 'closed'], name='ui{}'.format(i))
+        ...     ui.set_output(Recorder('ui{}-display'.format(i), log))
+        ...     ui.set_input(dict(open=door.open))
+        >>> door.set_output(Recorder('buzzer', log), priority=10)
+        >>> siren.set_output(Recorder('siren', log))
+        >>> siren.set_input(dict(on=door.open), priority=10)
+        >>> door.open = True
+        >>> log
+        ['buzzer', 'ui0', 'ui1', 'ui2', 'siren', 'ui0-display', 'ui1-display', 'ui2-display']
+        >>> [_.__name__ for _, _state in door.downstream('open')]
+        ['siren', 'ui0', 'ui1', 'ui2']
         """
 
         assert callable(obj.acquire_lock) and \
                callable(obj.change) and \
                callable(obj.release_lock) and \
                callable(obj.require_async)
-        self.output_callbacks.add(obj)
+        if self._frozen is not None:
+            raise FrozenError('Can\'t add an output to {} - the graph is frozen'.format(self.__name__))
+        outputs = self.output_callbacks
+        if self._output_ids is None:
+            self._output_ids = set()
+        if id(obj) in self._output_ids:
+            return
+        self._output_ids.add(id(obj))
+        self._prioritise(outputs, obj, lambda _: _, priority)
+        State.generation += 1
+        if obj.require_async():
+            self._mark_async()
 
 
 
@@ -0,0 +1,154 @@
+import logging
+from typing import List
+
+try:
+    import numpy
+except ImportError:
+    # optional - pip install aios[numpy]
+    numpy = None
+
+from aios.state import State, StateSchema
+from aios.propagation import transaction
+
+logger = logging.getLogger('aios.state_array')
+
+
+class ArrayState(State):
+    """
+    A State whose current state is an element of a StateArray - returned by indexing
+    the StateArray, and otherwise behaves like any other State.
+    """
+
+    __slots__ = ('_array', '_position')
+
+    _private = State._private | frozenset(('_array', '_position'))
+
+    def __init__(self, array: 'StateArray', position: int):
+        self._array = array
+        self._position = position
+        index = array.indices[position]
+        default = None if index < 0 else array.schema.states[index]
+        super().__init__(array.schema, default, '{}[{}]'.format(array.__name__, position))
+
+    @property
+    def _index(self):
+        index = self._array.indices[self._position]
+        return None if index < 0 else int(index)
+
+    @_index.setter
+    def _index(self, index):
+        self._array.indices[self._position] = -1 if index is None else index
+
+
+class StateArray(object):
+    """
+    StateArray holds the current state of a fleet of identical devices in a numpy
+    array (requires numpy), so fleet-wide queries and updates are vectorised.
+
+    >>> fleet = StateArray(['online', 'offline'], 1000, default='online', name='fleet')
+    >>> fleet[numpy.arange(1000) % 10 == 0] = 'offline'
+    >>> fleet.count('offline'), fleet.counts()
+    (100, {'online': 900, 'offline': 100})
+    >>> (fleet == 'offline')[:4]
+    array([ True, False, False, False])
+
+    Indexing with an int returns a State for that element, which can be linked to
+    other States as usual
+
+    >>> from aios import State
+    >>> alarm = State(['ringing', 'silent'], name='alarm', default='silent')
+    >>> alarm.ringing = fleet[5].offline
+    >>> print(fleet[5])
+    fleet[5]=[ONLINE, offline]
+
+    Bulk assignment writes straight to the array, except for elements which have
+    been accessed as States - those which change are changed through change_state
+    in a single transaction, so their links and outputs work as normal :-
+
+    >>> fleet.assign(slice(0, 10), 'offline')
+    9
+    >>> print(alarm)
+    alarm=[RINGING, silent]
+    >>> fleet[5] == 'offline'
+    True
+    """
+
+    def __init__(self, states: List, size: int, default: str=None, name: str=None):
+        if numpy is None:
+            raise Exception('StateArray requires numpy - pip install aios[numpy]')
+        self.schema = StateSchema.get(states)
+        self.__name__ = name
+        dtype = numpy.int8 if len(self.schema) < 2 ** 7 else numpy.int32
+        fill = -1 if default is None else self.schema.index[default]
+        self.indices = numpy.full(size, fill, dtype=dtype)
+        self.views = dict()
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, position: int) -> ArrayState:
+        position = int(position)
+        if position < 0:
+            position += len(self.indices)
+        try:
+            return self.views[position]
+        except KeyError:
+            view = self.views[position] = ArrayState(self, position)
+            return view
+
+    def __setitem__(self, key, new_state: str):
+        self.assign(key, new_state)
+
+    def __eq__(self, other):
+        """Vectorised comparison - a numpy bool array of which elements are in state other"""
+        if type(other) is str:
+            return self.indices == self.schema.index[other]
+        return NotImplemented
+
+    __hash__ = object.__hash__
+
+    def _changed(self, key, new_state: str):
+        """Write new_state to unviewed elements, returning the changed positions which have views"""
+        new = self.schema.index[new_state]
+        changed = numpy.zeros(len(self.indices), dtype=bool)
+        changed[key] = True
+        changed &= self.indices != new
+
+        viewed = [position for position in self.views if changed[position]]
+        count = int(numpy.count_nonzero(changed))
+        if viewed:
+            changed[viewed] = False
+        self.indices[changed] = new
+        return count, viewed
+
+    def assign(self, key, new_state: str) -> int:
+        """Change the elements selected by key (an int, slice, index array or bool mask),
+        returning the number of elements which changed"""
+        count, viewed = self._changed(key, new_state)
+        with transaction():
+            for position in viewed:
+                self.views[position].change_state(new_state, self)
+        return count
+
+    async def assign_async(self, key, new_state: str) -> int:
+        count, viewed = self._changed(key, new_state)
+        async with transaction():
+            for position in viewed:
+                await self.views[position].change_state_async(new_state, self)
+        return count
+
+    def count(self, state: str) -> int:
+        return int(numpy.count_nonzero(self.indices == self.schema.index[state]))
+
+    def counts(self):
+        counts = numpy.bincount(self.indices[self.indices >= 0], minlength=len(self.schema))
+        return dict(zip(self.schema.states, map(int, counts)))
+
+    def where(self, state: str):
+        """Return the positions of the elements in state"""
+        return numpy.flatnonzero(self.indices == self.schema.index[state])
+
+
+if numpy is None:
+    # the examples need numpy, so leave them out of doctest runs without it
+    StateArray.__doc__ = None
@@ -0,0 +1,141 @@
+import asyncio
+import collections
+import logging
+
+from aios.state import State
+
+logger = logging.getLogger('aios.stream')
+
+Change = collections.namedtuple('Change', ('state', 'old', 'new'))
+
+DROP_OLDEST = 'drop-oldest'
+COALESCE = 'coalesce'
+
+# State or Object -> list of Subscriptions
+_subscriptions = dict()
+
+
+def _dispatch(state: State, old: int, new: int):
+    event = None
+    node = state
+    while node is not None:
+        subscriptions = _subscriptions.get(node)
+        if subscriptions:
+            if event is None:
+                schema = state.schema
+                event = Change(state, None if old is None else schema.states[old], schema.states[new])
+            for _ in subscriptions:
+                _.push(event)
+        node = getattr(node, '__parent__', None)
+
+
+class Subscription(object):
+    """
+    A stream of the changes to a State, or to every State below an Object - see
+    State.changes() and Object._aios_changes()
+
+    >>> from aios import State
+    >>> door = State(['open', 'closed'], name='door', default='closed')
+    >>> changes = door.changes()
+    >>> door.open = True
+    >>> door.closed = True
+    >>> async def read(subscription, count):
+    ...     return [await subscription.__anext__() for _ in range(count)]
+    >>> loop = asyncio.get_event_loop()
+    >>> loop.run_until_complete(read(changes, 2))
+    [Change(state=door=[open, CLOSED], old='closed', new='open'), Change(state=door=[open, CLOSED], old='open', new='closed')]
+
+    Use it with async for, and close() it to end the iteration
+
+    >>> async def read_all(subscription):
+    ...     return [(_.old, _.new) async for _ in subscription]
+    >>> door.open = True
+    >>> changes.close()
+    >>> loop.run_until_complete(read_all(changes))
+    [('closed', 'open')]
+
+    Changes are queued for each subscription without waiting for the consumer, and at
+    most maxsize are kept. With policy='drop-oldest' the oldest changes are dropped
+    once the queue is full. With policy='coalesce' only the latest change to each
+    State is kept (with old being the state before the first of the changes) :-
+
+    >>> changes = door.changes(maxsize=10, policy='coalesce')
+    >>> for _ in range(5):
+    ...     door.closed = True
+    ...     door.open = True
+    >>> len(changes)
+    1
+    >>> loop.run_until_complete(read(changes, 1))
+    [Change(state=door=[OPEN, closed], old='open', new='open')]
+    >>> changes.close()
+    """
+
+    def __init__(self, source, maxsize: int=1000, policy: str=DROP_OLDEST):
+        assert policy in (DROP_OLDEST, COALESCE)
+        assert maxsize > 0
+        self.source = source
+        self.maxsize = maxsize
+        self.policy = policy
+        self.events = collections.OrderedDict() if policy == COALESCE else collections.deque()
+        self.dropped = 0
+        self.waiter = None
+        self.closed = False
+
+        subscriptions = _subscriptions.setdefault(source, [])
+        subscriptions.append(self)
+        if _dispatch not in State.observers:
+            State.observers.append(_dispatch)
+
+    def __len__(self):
+        return len(self.events)
+
+    def push(self, event: Change):
+        events = self.events
+        if self.policy == COALESCE:
+            pending = events.pop(event.state, None)
+            if pending is not None:
+                event = Change(event.state, pending.old, event.new)
+            elif len(events) >= self.maxsize:
+                events.popitem(last=False)
+                self.dropped += 1
+            events[event.state] = event
+        else:
+            if len(events) >= self.maxsize:
+                events.popleft()
+                self.dropped += 1
+            events.append(event)
+
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+
+        subscriptions = _subscriptions[self.source]
+        subscriptions.remove(self)
+        if not subscriptions:
+            del _subscriptions[self.source]
+        if not _subscriptions:
+            State.observers.remove(_dispatch)
+
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> Change:
+        while not self.events:
+            if self.closed:
+                raise StopAsyncIteration
+            self.waiter = asyncio.get_event_loop().create_future()
+            try:
+                await self.waiter
+            finally:
+                self.waiter = None
+
+        if self.policy == COALESCE:
+            return self.events.popitem(last=False)[1]
+        return self.events.popleft()
@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+"""
+Benchmarks for the aios hot paths.
+
+Each benchmark sets up a graph, then times a number of transitions (or other
+operations), repeating the measurement and reporting the best and median run.
+Results are written as JSON so runs can be compared across releases :-
+
+    python benchmarks/bench.py --output before.json
+    python benchmarks/bench.py --output after.json --compare before.json
+
+Use --quick for a smaller, faster run and --filter to run only the benchmarks
+whose name contains the given text.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from aios import Object, State
+from aios.frozen import freeze
+from aios.logic import ConditionalInputOutput
+
+BENCHMARKS = []
+
+
+def benchmark(name):
+    def register(func):
+        BENCHMARKS.append((name, func))
+        return func
+    return register
+
+
+class SyncOutput(object):
+    def acquire_lock(self, new_state):
+        pass
+
+    def change(self):
+        pass
+
+    def release_lock(self):
+        pass
+
+    def require_async(self):
+        return False
+
+
+class AsyncOutput(object):
+    async def acquire_lock(self, new_state):
+        pass
+
+    async def change(self):
+        pass
+
+    async def release_lock(self):
+        pass
+
+    def require_async(self):
+        return True
+
+
+def relay(name, default='off'):
+    return State(['on', 'off'], name=name, default=default)
+
+
+def toggle(state, count):
+    """Flip state count times, returning a function to time"""
+    def run():
+        for _ in range(count):
+            state.on = True
+            state.off = True
+    return run
+
+
+@benchmark('chain')
+def chain(scale):
+    """One change propagating down a chain of set_input links"""
+    length = 100 * scale
+    relays = [relay('relay{}'.format(i)) for i in range(length)]
+    for prev, _ in zip(relays, relays[1:]):
+        _.on = prev.on
+        _.off = prev.off
+    return toggle(relays[0], 10), 20 * length
+
+
+@benchmark('frozen_chain')
+def frozen_chain(scale):
+    """chain, after freeze()"""
+    length = 100 * scale
+    relays = [relay('relay{}'.format(i)) for i in range(length)]
+    for prev, _ in zip(relays, relays[1:]):
+        _.on = prev.on
+        _.off = prev.off
+    freeze(relays[0])
+    return toggle(relays[0], 10), 20 * length
+
+
+@benchmark('fan_out')
+def fan_out(scale):
+    """One change propagating to many directly linked States"""
+    width = 100 * scale
+    source = relay('source')
+    for i in range(width):
+        _ = relay('dest{}'.format(i))
+        _.on = source.on
+        _.off = source.off
+    return toggle(source, 10), 20 * (width + 1)
+
+
+@benchmark('fan_in')
+def fan_in(scale):
+    """Many States linked to a single State"""
+    width = 100 * scale
+    sources = [relay('source{}'.format(i)) for i in range(width)]
+    dest = relay('dest')
+    dest.on = [_.on for _ in sources]
+
+    def run():
+        for _ in sources:
+            _.on = True
+            dest.off = True
+        for _ in sources:
+            _.off = True
+    return run, 3 * width
+
+
+@benchmark('gate')
+def gate(scale):
+    """A ConditionalInputOutput with many inputs"""
+    width = 100 * scale
+    doors = [State(['open', 'closed'], name='door{}'.format(i), default='closed') for i in range(width)]
+    alarm = State(['ringing', 'silent'], name='alarm', default='silent')
+    ConditionalInputOutput(any, [_.open for _ in doors], [alarm.ringing])
+
+    def run():
+        for _ in doors:
+            _.open = True
+            alarm.silent = True
+            _.closed = True
+    return run, 3 * width
+
+
+@benchmark('frozen_gate')
+def frozen_gate(scale):
+    """gate, after freeze()"""
+    width = 100 * scale
+    doors = [State(['open', 'closed'], name='door{}'.format(i), default='closed') for i in range(width)]
+    alarm = State(['ringing', 'silent'], name='alarm', default='silent')
+    ConditionalInputOutput(any, [_.open for _ in doors], [alarm.ringing])
+    freeze(*doors)
+
+    def run():
+        for _ in doors:
+            _.open = True
+            alarm.silent = True
+            _.closed = True
+    return run, 3 * width
+
+
+@benchmark('sync_outputs')
+def sync_outputs(scale):
+    """Transitions on a State with sync outputs"""
+    state = relay('state')
+    for _ in range(10):
+        state.set_output(SyncOutput())
+    return toggle(state, 50 * scale), 100 * scale
+
+
+@benchmark('async_outputs')
+def async_outputs(scale):
+    """Transitions through change_state_async on a State with async outputs"""
+    state = relay('state')
+    for _ in range(10):
+        state.set_output(AsyncOutput())
+    count = 50 * scale
+    loop = asyncio.new_event_loop()
+
+    async def flip():
+        for _ in range(count):
+            await state.change_state_async('on')
+            await state.change_state_async('off')
+
+    return lambda: loop.run_until_complete(flip()), 2 * count
+
+
+@benchmark('object_tree')
+def object_tree(scale):
+    """Constructing an Object hierarchy with a State on each leaf"""
+    width = 10 * scale
+
+    def run():
+        Object(name='site', children={
+            'b{}'.format(b): Object(children={
+                'd{}'.format(d): Object(children={'door': State(['open', 'closed'])})
+                for d in range(width)})
+            for b in range(width)})
+    return run, width * width * 2
+
+
+@benchmark('repr')
+def tree_repr(scale):
+    """__repr__ of a large Object hierarchy"""
+    width = 10 * scale
+    site = Object(name='site', children={
+        'b{}'.format(b): Object(children={
+            'd{}'.format(d): Object(children={'door': State(['open', 'closed'])})
+            for d in range(width)})
+        for b in range(width)})
+    return lambda: repr(site), width * width * 2
+
+
+def measure(func, operations, repeat):
+    func()  # warm up
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    best = min(times)
+    median = statistics.median(times)
+    return dict(
+        operations=operations,
+        repeat=repeat,
+        best_seconds=best,
+        median_seconds=median,
+        ops_per_second=operations / median,
+        latency_us=median / operations * 1e6,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--quick', action='store_true', help='smaller graphs and fewer repeats')
+    parser.add_argument('--filter', default='', help='only run benchmarks containing this text')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='compare against results in this JSON file')
+    args = parser.parse_args()
+
+    scale, repeat = (1, 3) if args.quick else (10, 7)
+
+    results = dict(
+        python=platform.python_version(),
+        implementation=platform.python_implementation(),
+        machine=platform.machine(),
+        scale=scale,
+        benchmarks=dict(),
+    )
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as fh:
+            baseline = json.load(fh)['benchmarks']
+
+    print('{:<16} {:>14} {:>14} {:>10}'.format('benchmark', 'ops/s', 'latency (us)', 'vs base'))
+    for name, setup in BENCHMARKS:
+        if args.filter not in name:
+            continue
+        func, operations = setup(scale)
+        result = results['benchmarks'][name] = measure(func, operations, repeat)
+
+        ratio = ''
+        if baseline and name in baseline:
+            ratio = '{:.2f}x'.format(result['ops_per_second'] / baseline[name]['ops_per_second'])
+        print('{:<16} {:>14,.0f} {:>14.2f} {:>10}'.format(name, result['ops_per_second'], result['latency_us'], ratio))
+
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump(results, fh, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -10,15 +10,17 @@ setup(
     name='aios',
     version='0.1',
     packages=['aios'],
+    extras_require={
+        'numpy': ['numpy'],
+    },
     url='https://github.com/xlfe/aios',
     license='GNU General Public License v3.0',
     author='xlfe',
-    description='asynchronous state, transition and abstraction manager for Python 3.5+',
+    description='asynchronous state, transition and abstraction manager for Python 3.8+',
     long_description=long_description,
     long_description_content_type="text/markdown",
+    python_requires='>=3.8',
     classifiers = [
-        'Programming Language :: Python :: 3.5',
-        'Programming Language :: Python :: 3.6',
-        'Programming Language :: Python :: 3.7'
+        'Programming Language :: Python :: 3.8'
     ]
 )